@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import mmap
+import struct
+
+from array import array
+from threading import Lock, RLock
+from collections import OrderedDict
+from base58 import b58decode
+from .storage import Storage
+from utils import settings, log
+
+
+class ChainFiles:
+    """
+    Append-only files of one chain:
+
+    blocks.dat  records of `length(4 bytes) | canonical json of block`
+    height.idx  offset(8 bytes) of each record, the n-th entry is block at height n
+    hash.idx    raw block hash(32 bytes) | height(8 bytes) of each block
+    """
+    RECORD_HEADER = struct.Struct('>I')
+    OFFSET = struct.Struct('>Q')
+    HASH_ENTRY = struct.Struct('>32sQ')
+
+    def __init__(self, path: str):
+        self.path = path
+        # Held by reading as well, the data file may be closed by another thread
+        self.lock = RLock()
+        os.makedirs(path, exist_ok=True)
+
+        self.offsets = array('Q')
+        self.hashes = {}
+
+        # Only data file is kept open, index files are opened when appending.
+        # It is closed by `close` and opened again when it is used.
+        self.__blocks = None
+        self.__map = None
+        self.__recover()
+
+    @property
+    def blocks(self):
+        with self.lock:
+            if self.__blocks is None:
+                self.__blocks = open(os.path.join(self.path, 'blocks.dat'), 'a+b')
+            return self.__blocks
+
+    @property
+    def is_open(self) -> bool:
+        return self.__blocks is not None
+
+    def close(self):
+        """
+        Release the file descriptors, indexes stay in memory
+        """
+        with self.lock:
+            if self.__blocks is not None:
+                self.__blocks.close()
+                self.__blocks = None
+            # A map still referred by views is released with them
+            self.__map = None
+
+    @property
+    def height(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def end(self) -> int:
+        """
+        :return: offset right after the last record
+        """
+        if self.height == 0:
+            return 0
+        last = self.offsets[-1]
+        return last + self.RECORD_HEADER.size + self.RECORD_HEADER.unpack(self.read(last, self.RECORD_HEADER.size))[0]
+
+    def __index(self, name: str):
+        return open(os.path.join(self.path, name), 'a+b')
+
+    def __recover(self):
+        # Drop torn entries and records written after the last complete index entry
+        with self.__index('height.idx') as height_index:
+            size = os.fstat(height_index.fileno()).st_size
+            height_index.seek(0)
+            self.offsets.frombytes(height_index.read(size - size % self.OFFSET.size))
+            if sys.byteorder == 'little':
+                self.offsets.byteswap()
+
+            data_size = os.fstat(self.blocks.fileno()).st_size
+            while self.height > 0 and self.offsets[-1] + self.RECORD_HEADER.size > data_size:
+                self.offsets.pop()
+            if self.height > 0 and self.end > data_size:
+                self.offsets.pop()
+            height_index.truncate(self.height * self.OFFSET.size)
+        self.blocks.truncate(self.end)
+
+        with self.__index('hash.idx') as hash_index:
+            # Entries are in height order, a torn entry would misalign the ones appended after it
+            size = os.fstat(hash_index.fileno()).st_size
+            size = min(size - size % self.HASH_ENTRY.size, self.height * self.HASH_ENTRY.size)
+            hash_index.truncate(size)
+            hash_index.seek(0)
+            entries = hash_index.read(size)
+        for i in range(len(entries) // self.HASH_ENTRY.size):
+            raw, height = self.HASH_ENTRY.unpack_from(entries, i * self.HASH_ENTRY.size)
+            if height < self.height:
+                self.hashes[raw] = height
+        if len(self.hashes) != self.height:
+            self.__rebuild_hash_index()
+
+    def __rebuild_hash_index(self):
+        log.warning(f'Rebuild hash index of {self.path}')
+        self.hashes = {}
+        with self.__index('hash.idx') as hash_index:
+            hash_index.truncate(0)
+            for height in range(self.height):
+                raw = b58decode(self.get(height)['hash'])
+                self.hashes[raw] = height
+                hash_index.write(self.HASH_ENTRY.pack(raw, height))
+
+    def read(self, offset: int, size: int) -> bytes:
+        with self.lock:
+            return os.pread(self.blocks.fileno(), size, offset)
+
+    def view(self, begin: int, stop: int) -> memoryview:
+        """
+        Zero-copy view of data file, it is remapped when the file grows
+        """
+        with self.lock:
+            if self.__map is None or len(self.__map) < stop:
+                # Old map is released when no views are referring to it
+                self.__map = mmap.mmap(self.blocks.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self.__map)[begin:stop]
+
+    def record(self, height: int) -> bytes:
+        offset = self.offsets[height]
+        size, = self.RECORD_HEADER.unpack(self.read(offset, self.RECORD_HEADER.size))
+        return self.read(offset + self.RECORD_HEADER.size, size)
+
+    def records(self, start: int, end: int) -> list:
+        """
+        Records of [start, end] as views of the memory-mapped data file
+        """
+        start = max(start, 0)
+        end = min(end, self.height - 1)
+        if start > end:
+            return []
+        begin = self.offsets[start]
+        stop = self.offsets[end + 1] if end + 1 < self.height else self.end
+        data = self.view(begin, stop)
+        result = []
+        position = 0
+        while position < len(data):
+            size, = self.RECORD_HEADER.unpack_from(data, position)
+            position += self.RECORD_HEADER.size
+            result.append(data[position:position + size])
+            position += size
+        return result
+
+    def get(self, height: int) -> dict:
+        return json.loads(self.record(height).decode('utf8'))
+
+    def find(self, block_hash: str):
+        try:
+            return self.hashes.get(b58decode(block_hash))
+        except ValueError:
+            return None
+
+    def append(self, blocks: list) -> int:
+        """
+        :param blocks: block dicts sorted by height
+        :return: count of blocks appended
+        """
+        with self.lock:
+            offset = self.end
+            data = bytearray()
+            offsets = []
+            entries = bytearray()
+            for block in blocks:
+                if block['height'] != self.height + len(offsets):
+                    break
+                encoded = json.JSONEncoder(
+                    separators=(',', ':'),
+                    sort_keys=True,
+                    ensure_ascii=False
+                ).encode(block).encode('utf8')
+                offsets.append(offset + len(data))
+                data += self.RECORD_HEADER.pack(len(encoded)) + encoded
+                entries += self.HASH_ENTRY.pack(b58decode(block['hash']), block['height'])
+
+            if len(offsets) == 0:
+                return 0
+
+            # Data is on disk before index, a crash in between leaves records which are dropped on recovery
+            self.blocks.write(data)
+            self.blocks.flush()
+            os.fsync(self.blocks.fileno())
+            with self.__index('height.idx') as height_index:
+                height_index.write(b''.join(self.OFFSET.pack(o) for o in offsets))
+            with self.__index('hash.idx') as hash_index:
+                hash_index.write(entries)
+
+            for i, o in enumerate(offsets):
+                self.hashes[bytes(entries[i * self.HASH_ENTRY.size:i * self.HASH_ENTRY.size + 32])] = self.height
+                self.offsets.append(o)
+            return len(offsets)
+
+
+class EmbeddedStorage(Storage):
+    """
+    Storage engine keeps every chain in its own append-only files,
+    no database service is needed.
+
+    Indexes of every chain used are kept in memory, but data files of only
+    `settings.database.files` chains recently used are kept open.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.path = os.path.expanduser(settings.database.path)
+        os.makedirs(self.path, exist_ok=True)
+        self.__lock = Lock()
+        self.__chains = {}
+        self.__files = {}
+        # chain_id -> ChainFiles with open data file, least recently used first
+        self.__open = OrderedDict()
+
+        self.__catalogue = open(os.path.join(self.path, 'chains.dat'), 'a+')
+        self.__catalogue.seek(0)
+        for line in self.__catalogue:
+            try:
+                chain = json.loads(line)
+                self.__chains[chain['public_key']] = chain
+            except (ValueError, KeyError):
+                # Torn line at the end
+                pass
+
+    def files(self, chain_id: str):
+        files = self.__files.get(chain_id)
+        if files is None:
+            with self.__lock:
+                files = self.__files.get(chain_id)
+                if files is None and chain_id in self.__chains:
+                    files = ChainFiles(os.path.join(self.path, chain_id))
+                    self.__files[chain_id] = files
+        if files is not None:
+            self.__touch(chain_id, files)
+        return files
+
+    def __touch(self, chain_id: str, files: ChainFiles):
+        evicted = []
+        with self.__lock:
+            self.__open[chain_id] = files
+            self.__open.move_to_end(chain_id)
+            while len(self.__open) > settings.database.files:
+                evicted.append(self.__open.popitem(last=False)[1])
+        # Closed outside of the storage lock, a reader of it opens it again
+        for files in evicted:
+            files.close()
+
+    def scan_tips(self) -> dict:
+        tips = {}
+        for chain_id in list(self.__chains):
+            files = self.files(chain_id)
+            if files.height > 0:
+                tips[chain_id] = (files.height, files.get(files.height - 1)['hash'])
+        return tips
+
+    def save_chain(self, chain: dict):
+        with self.__lock:
+            if chain['public_key'] in self.__chains:
+                return
+            self.__catalogue.write(json.JSONEncoder(separators=(',', ':')).encode(chain) + '\n')
+            self.__catalogue.flush()
+            self.__chains[chain['public_key']] = chain
+
+    def get_chain(self, public_key: str):
+        return self.__chains.get(public_key)
+
+    def all_chains(self):
+        return list(self.__chains.values())
+
+    def insert_block(self, block: dict) -> bool:
+        return self.insert_blocks([block]) == 1
+
+    def insert_blocks(self, blocks: list) -> int:
+        files = self.files(blocks[0]['chain_id'])
+        if files is None:
+            return 0
+        return files.append(blocks)
+
+    def get_block(self, chain_id: str, height: int = None, block_hash: str = None):
+        files = self.files(chain_id)
+        if files is None:
+            return None
+        if block_hash is not None and len(block_hash) > 0:
+            found = files.find(block_hash)
+            if found is None or (height is not None and height != found):
+                return None
+            height = found
+        if height is None or height < 0 or height >= files.height:
+            return None
+        return files.get(height)
+
+    def get_blocks(self, chain_id: str, start: int, end: int):
+        files = self.files(chain_id)
+        if files is None:
+            return []
+        return [json.loads(bytes(record)) for record in files.records(start, end)]
+
+    def get_raw_blocks(self, chain_id: str, start: int, end: int) -> list:
+        files = self.files(chain_id)
+        if files is None:
+            return []
+        return files.records(start, end)
@@ -1,90 +1,30 @@
 import json
+import os
+import multiprocessing
 
-from dataclasses import dataclass
-from calendar import timegm
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 from datetime import datetime
-from hashlib import sha256
+from threading import Lock
 from base58 import b58encode
-from .key import Key
-from .storage import Database
+from validation.block import BaseBlock, initialize_worker, verify_block
+from .key import Key, KeyRing
+from .storage import Database, AppendResult
 from utils.reprutil import flat_dict_for_repr
-from utils import log
-
-
-@dataclass
-class Block:
-    block_hash: str = ''
-    prev_hash: str = ''
-    time: datetime = datetime.utcnow()
-    signature: str = ''
-    chain_id: str = ''
-    height: int = 0
-    payload: str = ''
-
-    def __init__(self, data: dict = None):
-        if data is not None:
-            self.block_hash = data.get('hash')
-            self.prev_hash = data.get('prev_hash')
-            self.time = datetime.utcfromtimestamp(data.get('time'))
-            self.signature = data.get('signature')
-            self.chain_id = data.get('chain_id')
-            self.height = data.get('height')
-            self.payload = data.get('payload')
+from utils import Singleton, settings, log
 
-    @property
-    def is_genesis(self):
-        return self.height == 0
 
-    @property
-    def utctime(self) -> int:
-        return timegm(self.time.utctimetuple())
+class Block(BaseBlock):
+    __slots__ = ()
 
-    @property
-    def dict(self) -> dict:
-        data = {
-            'hash': self.block_hash,
-            'time': int(self.utctime),
-            'signature': self.signature,
-            'chain_id': self.chain_id,
-            'height': self.height,
-            'payload': self.payload
-        }
-        if self.prev_hash is not None and len(self.prev_hash) > 0:
-            data['prev_hash'] = self.prev_hash
-        return data
-
-    @property
-    def data_for_hashing(self) -> bytes:
-        data = self.dict
-        del data['hash']
-        del data['signature']
-        return json.JSONEncoder(
-            separators=(',', ':'),
-            sort_keys=True,
-            ensure_ascii=False
-        ).encode(data).encode('utf8')
-
-    @property
-    def data(self) -> bytes:
-        return json.JSONEncoder(
-            separators=(',', ':'),
-            sort_keys=True,
-            ensure_ascii=False
-        ).encode(self.dict).encode('utf8')
-
-    @property
-    def size(self) -> int:
-        return len(self.data)
+    def verify(self) -> bool:
+        return self.verify_with(KeyRing().get(self.chain_id))
 
     @property
     def is_valid(self) -> bool:
         start = datetime.utcnow()
 
-        key = Key(self.chain_id)
-        valid = (self.height == 0 or (self.prev_hash is not None and len(self.prev_hash) > 0)) and \
-            b58encode(sha256(self.data_for_hashing).digest()).decode('utf8') == self.block_hash and \
-            key.verify(self.signature, self.data_for_hashing)
+        valid = self.verify()
 
         end = datetime.utcnow()
         log.info("Block validated in %.03f secs" % (end - start).total_seconds())
@@ -92,38 +32,86 @@ class Block:
         return valid
 
     def __repr__(self):
-        return flat_dict_for_repr({**self.dict, 'size': f'{len(self.data)} bytes'})
+        return flat_dict_for_repr({**self.dict, 'size': f'{self.size} bytes'})
 
 
 class Blockchain:
+    __validation_pool = None
+    __validation_workers = settings.validation.workers if settings.validation.workers > 0 else os.cpu_count() or 1
+
+    __validation_pool_lock = Lock()
+
+    @classmethod
+    def validation_pool(cls) -> ProcessPoolExecutor:
+        """
+        Workers are started by a fork server rather than forked from this process,
+        the pool is created from storage threads and a forked worker would inherit
+        locks held by other threads. Workers import nothing that loads settings,
+        the key cache is configured by the pool instead.
+        """
+        with cls.__validation_pool_lock:
+            if cls.__validation_pool is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                cls.__validation_pool = ProcessPoolExecutor(
+                    max_workers=cls.__validation_workers,
+                    mp_context=context,
+                    initializer=initialize_worker,
+                    initargs=(settings.keys.capacity, settings.keys.precompute)
+                )
+        return cls.__validation_pool
+
+    @classmethod
+    def validate_blocks(cls, blocks: list) -> list:
+        """
+        Validate a batch of blocks, hashes and signatures are verified in the
+        validation pool, then blocks of a same chain are checked to be linked
+        in height order.
+
+        :param blocks: blocks sorted by height
+        :return: a list of bool for each block in the same order
+        """
+        if len(blocks) == 0:
+            return []
+
+        start = datetime.utcnow()
+
+        if len(blocks) == 1 or cls.__validation_workers == 1:
+            results = [block.verify() for block in blocks]
+        else:
+            chunk = max(1, len(blocks) // (cls.__validation_workers * 4))
+            results = list(cls.validation_pool().map(verify_block, [block.data for block in blocks], chunksize=chunk))
+
+        last = {}
+        for index, block in enumerate(blocks):
+            prev = last.get(block.chain_id)
+            if prev is not None and blocks[prev].height + 1 == block.height:
+                results[index] = results[index] and results[prev] and \
+                    blocks[prev].block_hash == block.prev_hash
+            last[block.chain_id] = index
+
+        end = datetime.utcnow()
+        log.info("%d blocks validated in %.03f secs" % (len(blocks), (end - start).total_seconds()))
+
+        return results
+
     @classmethod
     def all_chains(cls):
-        objects = Database().all_chains()
-        return [cls(Key(obj['public_key'], obj['private_key'])) for obj in objects]
+        return ChainRegistry().all()
 
     @classmethod
     def remote_chain(cls, public_key):
-        chain = cls.load(public_key)
-        if chain is None:
-            remote = cls(Key(public_key))
-            remote.save()
-            return remote
-        return chain
+        return ChainRegistry().get_or_create(public_key)
 
     @classmethod
     def load(cls, chain_id: str):
         """
-        Load a exist chain from database
+        Load a exist chain from chain registry
 
         :param chain_id: chain id = public key
         :return:
         """
-        info = Database().get_chain(chain_id)
-        if info is not None:
-            if info.get('private_key') is not None and len(info['private_key']) > 0:
-                return cls(Key(chain_id, info['private_key']))
-            return cls(Key(chain_id))
-        return None
+        return ChainRegistry().get(chain_id)
 
     # TODO: validate information
     @classmethod
@@ -137,7 +125,9 @@ class Blockchain:
         :param kwargs: chain info
         :return: Blockchain
         """
-        chain = cls(Key())
+        key = Key()
+        KeyRing().add(key)
+        chain = cls(key)
         block = chain.create_block(json.JSONEncoder(
             separators=(',', ':'),
             sort_keys=True,
@@ -147,6 +137,12 @@ class Blockchain:
         chain.save_block(block)
         return chain
 
+    @classmethod
+    def from_document(cls, document: dict):
+        if document.get('private_key') is not None and len(document['private_key']) > 0:
+            return cls(KeyRing().get(document['public_key'], document['private_key']))
+        return cls(KeyRing().get(document['public_key']))
+
     def __init__(self, key: Key):
         self.key = key
         self.database = Database()
@@ -154,13 +150,13 @@ class Blockchain:
 
     @property
     def info(self):
-        if self.__info is not None:
-            return self.__info
-        else:
+        # Genesis block never changes, its payload is cached once loaded
+        if self.__info is None:
             genesis = self.get_block(0)
-            if genesis is not None:
-                self.__info = json.JSONDecoder().decode(genesis.payload)
-            return {**self.__info, 'chain_id': self.id}
+            if genesis is None:
+                return {'chain_id': self.id}
+            self.__info = json.JSONDecoder().decode(genesis.payload)
+        return {**self.__info, 'chain_id': self.id}
 
     @property
     def id(self):
@@ -179,11 +175,20 @@ class Blockchain:
         return Block(info) if info is not None else None
 
     def get_blocks(self, start: int, end: int):
-        blocks = self.database.get_blocks(self.id, start, end)
+        blocks = self.database.get_raw_blocks(self.id, start, end)
         if blocks is not None:
-            return [Block(info) for info in blocks]
+            return [Block.from_raw(data) for data in blocks]
         return None
 
+    def get_raw_blocks(self, start: int, end: int) -> list:
+        return self.database.get_raw_blocks(self.id, start, end)
+
+    def iter_raw_blocks(self, start: int, end: int):
+        """
+        :return: generator of lists of encoded blocks, see `Storage.iter_raw_blocks`
+        """
+        return self.database.iter_raw_blocks(self.id, start, end)
+
     def create_block(self, payload: str) -> Block:
         if isinstance(payload, dict) or isinstance(payload, list):
             payload = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode(payload)
@@ -192,31 +197,60 @@ class Blockchain:
         block = Block()
         block.payload = payload
         block.chain_id = self.id
-        block.height = self.height
+        block.height, tip_hash = self.database.get_tip(self.id)
         if block.height > 0:
-            block.prev_hash = self.database.get_block(self.id, block.height - 1)['hash']
-        block.block_hash = b58encode(sha256(block.data_for_hashing).digest()).decode('utf8')
-        block.signature = b58encode(self.key.sign(block.data_for_hashing)).decode('utf8')
+            block.prev_hash = tip_hash
+        data = block.data_for_hashing
+        block.block_hash = Block.hash_data(data)
+        block.signature = b58encode(self.key.sign(data)).decode('utf8')
         return block
 
-    def save_block(self, block: Block) -> bool:
-        if block.is_valid and self.get_block(block.height) is None:
-            if self.height == 0:
-                self.database.save_block(block.dict)
-                return True
-            elif self.height > 0:
-                prev = self.get_block(block.height - 1)
-                if prev is not None and prev.block_hash == block.prev_hash:
-                    self.database.save_block(block.dict)
-                    return True
-        return False
+    def save_block(self, block: Block, verified: bool = False) -> AppendResult:
+        """
+        Append a block to current tip of chain
+
+        :param block: block to save
+        :param verified: skip hash and signature checking if it has been done by `validate_blocks`
+        :return: AppendResult.SAVED or the reason why it is not saved
+        """
+        if block.chain_id != self.id or not (verified or block.is_valid):
+            return AppendResult.INVALID
+        return self.database.save_block(block.dict)
+
+    def save_blocks(self, blocks: list, verified: bool = False) -> int:
+        """
+        Save a contiguous run of blocks of this chain in one write,
+        blocks already exist are skipped and the first new block should link to current tip.
+        Saving stops at the first block which is invalid or not linked.
+
+        :param blocks: blocks sorted by height
+        :param verified: skip hash and signature checking if it has been done by `validate_blocks`
+        :return: count of new blocks saved
+        """
+        height, tip_hash = self.database.get_tip(self.id)
+        segment = [block for block in blocks if block.height >= height]
+        if len(segment) == 0:
+            return 0
+
+        results = [True] * len(segment) if verified else Blockchain.validate_blocks(segment)
+        linked = []
+        for block, valid in zip(segment, results):
+            if not valid or block.chain_id != self.id or block.height != height or \
+                    (height > 0 and block.prev_hash != tip_hash):
+                log.warning(f'Segment of {self.id} broken at height {block.height}')
+                break
+            linked.append(block.dict)
+            height, tip_hash = height + 1, block.block_hash
+
+        return self.database.save_blocks(linked)
 
     def save(self) -> bool:
-        if Blockchain.load(self.id) is None:
+        if self.database.get_chain(self.id) is None:
             self.database.save_chain({
                 'public_key': self.key.public_key,
                 'private_key': self.key.private_key
             })
+            ChainRegistry().add(self)
             return True
         return False
 
@@ -226,3 +260,65 @@ class Blockchain:
         elif isinstance(key, str):
             return Block(self.database.get_block(self.id, block_hash=key))
         return None
+
+
+class ChainRegistry(metaclass=Singleton):
+    """
+    Identity map of chains, keeps one live Blockchain object for each saved chain.
+    It is filled from database once and updated when chains are saved.
+    """
+
+    def __init__(self):
+        self.__chains = None
+        self.__lock = Lock()
+
+    def load(self):
+        start = datetime.utcnow()
+        chains = {}
+        for document in Database().all_chains():
+            chain = Blockchain.from_document(document)
+            chains[chain.id] = chain
+        with self.__lock:
+            self.__chains = chains
+        end = datetime.utcnow()
+        log.info("%d chains loaded in %.03f secs" % (len(chains), (end - start).total_seconds()))
+
+    def __ensure_loaded(self):
+        if self.__chains is None:
+            self.load()
+
+    def get(self, chain_id: str) -> Optional[Blockchain]:
+        self.__ensure_loaded()
+        return self.__chains.get(chain_id)
+
+    def get_or_create(self, chain_id: str) -> Blockchain:
+        """
+        :param chain_id: chain id of a remote chain
+        :return: registered chain, it is saved first if it is new
+        """
+        chain = self.get(chain_id)
+        if chain is not None:
+            return chain
+        with self.__lock:
+            chain = self.__chains.get(chain_id)
+            if chain is None:
+                chain = Blockchain(KeyRing().get(chain_id))
+                chain.database.save_chain({
+                    'public_key': chain.id,
+                    'private_key': chain.key.private_key
+                })
+                self.__chains[chain_id] = chain
+        return chain
+
+    def add(self, chain: Blockchain):
+        self.__ensure_loaded()
+        with self.__lock:
+            self.__chains.setdefault(chain.id, chain)
+
+    def all(self) -> list:
+        self.__ensure_loaded()
+        return list(self.__chains.values())
+
+    def __len__(self):
+        self.__ensure_loaded()
+        return len(self.__chains)
@@ -1,21 +1,226 @@
+from json import JSONEncoder
 from pymongo import MongoClient, ASCENDING, DESCENDING
-from utils import Singleton, settings, log
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from utils import settings, log
 from datetime import datetime
+from threading import Lock
+from enum import Enum
 
 
-class Database(metaclass=Singleton):
+def encode_block(block: dict) -> bytes:
+    block.pop('_id', None)
+    return JSONEncoder(separators=(',', ':'), sort_keys=True, ensure_ascii=False).encode(block).encode('utf8')
+
+
+class AppendResult(Enum):
+    SAVED = 'saved'
+    # Block with same height and hash is already saved
+    EXISTS = 'exists'
+    # Block with same height but different hash is saved, or it is not linked to the tip
+    FORK = 'fork'
+    # Block is higher than the tip, blocks between are missing
+    GAP = 'gap'
+    INVALID = 'invalid'
+
+
+class Storage:
+    """
+    Interface of storage engines.
+
+    Engines only need to implement raw reads and writes of chains and blocks,
+    chain tips and append checking are shared by all engines.
+    """
+
     def __init__(self):
-        db_settings = settings.database
-        self.database = MongoClient(db_settings.host, db_settings.port)[db_settings.name]
+        # chain_id -> (height, tip hash), height is the count of blocks in chain
+        self.__tips = None
+        self.__tips_lock = Lock()
+        self.__tip_listeners = []
 
     def save_chain(self, chain: dict):
-        self.database.chains.insert_one(chain)
+        raise NotImplementedError
+
+    def get_chain(self, public_key: str):
+        raise NotImplementedError
+
+    def all_chains(self):
+        raise NotImplementedError
+
+    def get_block(self, chain_id: str, height: int = None, block_hash: str = None):
+        raise NotImplementedError
+
+    def get_blocks(self, chain_id: str, start: int, end: int):
+        raise NotImplementedError
+
+    def get_raw_blocks(self, chain_id: str, start: int, end: int) -> list:
+        """
+        Canonical encoded blocks of [start, end], engines keeping encoded blocks
+        should override it to return them without decoding.
+
+        :return: list of bytes-like objects
+        """
+        return [encode_block(block) for block in self.get_blocks(chain_id, start, end)]
+
+    def iter_raw_blocks(self, chain_id: str, start: int, end: int, batch: int = 32):
+        """
+        Canonical encoded blocks of [start, end] read batch by batch,
+        only one batch is held when the caller consumes them in order.
+
+        :param batch: count of blocks in each batch
+        :return: generator of lists of bytes-like objects
+        """
+        while start <= end:
+            blocks = self.get_raw_blocks(chain_id, start, min(end, start + batch - 1))
+            if len(blocks) == 0:
+                return
+            yield blocks
+            start += len(blocks)
+
+    def scan_tips(self) -> dict:
+        """
+        :return: chain_id -> (height, hash of last block) of every chain has blocks
+        """
+        raise NotImplementedError
+
+    def insert_block(self, block: dict) -> bool:
+        """
+        :param block: block dict
+        :return: False if the height is already taken
+        """
+        raise NotImplementedError
+
+    def insert_blocks(self, blocks: list) -> int:
+        """
+        :param blocks: block dicts sorted by height
+        :return: count of blocks inserted from the beginning
+        """
+        raise NotImplementedError
+
+    def migrate(self):
+        pass
+
+    def load_tips(self):
+        start = datetime.utcnow()
+        tips = self.scan_tips()
+        with self.__tips_lock:
+            self.__tips = tips
+        end = datetime.utcnow()
+        log.info("Tips of %d chains loaded in %.03f secs" % (len(tips), (end - start).total_seconds()))
+
+    def get_tip(self, chain_id: str) -> tuple:
+        """
+        :param chain_id: chain id
+        :return: (height, hash of last block), (0, None) for a chain without blocks
+        """
+        if self.__tips is None:
+            self.load_tips()
+        return self.__tips.get(chain_id, (0, None))
 
-    def save_block(self, block: dict):
+    def get_height(self, chain_id):
+        return self.get_tip(chain_id)[0]
+
+    def add_tip_listener(self, listener):
+        """
+        :param listener: callable with (chain_id, height, tip hash), called after a tip moved
+        """
+        self.__tip_listeners.append(listener)
+
+    def save_block(self, block: dict) -> AppendResult:
+        """
+        Append a block to the tip of its chain with one write,
+        the engine rejects it if another writer got the height first.
+
+        :param block: block dict
+        :return: AppendResult
+        """
         start = datetime.utcnow()
-        self.database.blocks.insert_one(block)
+        height, tip_hash = self.get_tip(block['chain_id'])
+        if block['height'] > height:
+            return AppendResult.GAP
+        if block['height'] < height:
+            return self.__conflict(block)
+        if height > 0 and block.get('prev_hash') != tip_hash:
+            return AppendResult.FORK
+
+        if not self.insert_block(block):
+            return self.__conflict(block)
+        self.__move_tip(block, block)
         end = datetime.utcnow()
         log.info("New block saved in %.03f secs" % (end - start).total_seconds())
+        return AppendResult.SAVED
+
+    def save_blocks(self, blocks: list) -> int:
+        """
+        Save a contiguous segment of blocks of one chain in one ordered write
+
+        :param blocks: block dicts sorted by height
+        :return: count of blocks saved from the beginning of the segment
+        """
+        if len(blocks) == 0:
+            return 0
+
+        start = datetime.utcnow()
+        saved = self.insert_blocks(blocks)
+        if saved < len(blocks):
+            log.warning(f'Segment write stopped at height {blocks[0]["height"] + saved}')
+        if saved > 0:
+            self.__move_tip(blocks[0], blocks[saved - 1])
+        end = datetime.utcnow()
+        log.info("%d blocks saved in %.03f secs" % (saved, (end - start).total_seconds()))
+        return saved
+
+    def __conflict(self, block: dict) -> AppendResult:
+        exist = self.get_block(block['chain_id'], block['height'])
+        if exist is not None and exist['hash'] == block['hash']:
+            return AppendResult.EXISTS
+        return AppendResult.FORK
+
+    def __move_tip(self, first: dict, last: dict):
+        if self.__tips is None:
+            self.load_tips()
+            return
+        with self.__tips_lock:
+            height, _ = self.__tips.get(first['chain_id'], (0, None))
+            if first['height'] != height:
+                return
+            self.__tips[first['chain_id']] = (last['height'] + 1, last['hash'])
+        for listener in self.__tip_listeners:
+            listener(first['chain_id'], last['height'] + 1, last['hash'])
+
+
+class MongoStorage(Storage):
+    def __init__(self):
+        super().__init__()
+        db_settings = settings.database
+        self.database = MongoClient(db_settings.host, db_settings.port)[db_settings.name]
+
+    # Sort direction matches (chain_id, height) index walking backward
+    __tips_pipeline = [
+        {'$sort': {'chain_id': DESCENDING, 'height': DESCENDING}},
+        {'$group': {'_id': '$chain_id', 'height': {'$first': '$height'}, 'hash': {'$first': '$hash'}}}
+    ]
+
+    def scan_tips(self) -> dict:
+        cursor = self.database.blocks.aggregate(self.__tips_pipeline, allowDiskUse=True)
+        return {tip['_id']: (tip['height'] + 1, tip['hash']) for tip in cursor}
+
+    def save_chain(self, chain: dict):
+        self.database.chains.insert_one(chain)
+
+    def insert_block(self, block: dict) -> bool:
+        try:
+            self.database.blocks.insert_one(block)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def insert_blocks(self, blocks: list) -> int:
+        try:
+            self.database.blocks.insert_many(blocks, ordered=True)
+            return len(blocks)
+        except BulkWriteError as error:
+            log.warning(f'{error.details.get("writeErrors")}')
+            return error.details.get('nInserted', 0)
 
     def get_chain(self, public_key: str):
         return self.database.chains.find_one({'public_key': public_key})
@@ -35,11 +240,60 @@ class Database(metaclass=Singleton):
         query = {'chain_id': chain_id, 'height': {'$gte': start, '$lte': end}}
         return self.database.blocks.find(query).sort('height', ASCENDING)
 
-    def get_height(self, chain_id):
-        return self.database.blocks.count({'chain_id': chain_id})
+    def iter_raw_blocks(self, chain_id: str, start: int, end: int, batch: int = 32):
+        # One cursor for the whole range, the server returns `batch` documents each time
+        cursor = self.get_blocks(chain_id, start, end).batch_size(batch)
+        try:
+            result = []
+            for block in cursor:
+                result.append(encode_block(block))
+                if len(result) >= batch:
+                    yield result
+                    result = []
+            if len(result) > 0:
+                yield result
+        finally:
+            cursor.close()
+
+    def explain_queries(self, chain_id: str = '') -> dict:
+        """
+        Query plans of every hot query, keep it updated with queries above
+
+        :param chain_id: a chain id to fill into queries
+        :return: query name -> explain result
+        """
+        blocks = self.database.blocks
+        return {
+            'get_chain': self.database.chains.find({'public_key': chain_id}).limit(1).explain(),
+            'get_block(height)': blocks.find({'chain_id': chain_id, 'height': 0}).limit(1).explain(),
+            'get_block(hash)': blocks.find({'chain_id': chain_id, 'hash': ''}).limit(1).explain(),
+            'get_blocks': blocks.find(
+                {'chain_id': chain_id, 'height': {'$gte': 0, '$lte': 0}}
+            ).sort('height', ASCENDING).explain(),
+            'load_tips': self.database.command(
+                'aggregate', 'blocks', pipeline=self.__tips_pipeline, explain=True
+            )
+        }
 
     def migrate(self):
         log.info('Create index for "public_key" in "chains".')
         self.database.chains.create_index([('public_key', ASCENDING)], unique=True)
         log.info('Create index for "height" in "blocks".')
         self.database.blocks.create_index([('height', DESCENDING)])
+
+
+class Database:
+    """
+    `Database()` gives the storage engine selected by `database.engine` setting,
+    the engine is created once per process.
+    """
+    __engine = None
+
+    def __new__(cls) -> Storage:
+        if cls.__engine is None:
+            if settings.database.engine == 'embedded':
+                from .embedded import EmbeddedStorage
+                cls.__engine = EmbeddedStorage()
+            else:
+                cls.__engine = MongoStorage()
+        return cls.__engine
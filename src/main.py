@@ -3,12 +3,9 @@ import sys
 import os
 import signal
 import logging
+import multiprocessing
 
 from collections import namedtuple
-from sharing import ShareManager, PeerManager, Peer
-from scripts.migrate import migrate
-from utils import settings, log
-from manage import ManageClient, run_rpc_server
 
 
 def args_filter(args, options):
@@ -53,6 +50,11 @@ class Main:
         sub.add_argument('address', type=str, help='Peer address (eg. 127.0.0.1:32767)')
         sub.add_argument('-s', '--self', action='store_true', help='Add current host as a peer to database.')
         sub.set_defaults(func=self.add_peer)
+        # ---- Level 2
+        # {migrate} {check}
+        self.migrate_subs\
+            .add_parser('check', help='Check if every query is using index.')\
+            .set_defaults(func=self.check_migrations)
 
         # Level 1
         # {rpc}
@@ -114,7 +116,10 @@ class Main:
                         log.removeHandler(handler)
 
                 log.info(f'Running with PID {os.getpid()}')
+                Main.migrate()
                 log.info(PeerManager())
+                Database().load_tips()
+                ChainRegistry().load()
                 ShareManager().start()
                 with open('/tmp/infnote_chain.pid', 'w+') as file:
                     file.write(f'{os.getpid()}')
@@ -122,7 +127,10 @@ class Main:
             else:
                 log.info('Infnote Chain P2P Network Started in child process.')
         else:
+            Main.migrate()
             log.info(PeerManager())
+            Database().load_tips()
+            ChainRegistry().load()
             ShareManager().start()
             run_rpc_server()
 
@@ -143,8 +151,17 @@ class Main:
         self.start_server(namedtuple('args', ['fore'])(fore=False))
 
     @staticmethod
-    def migrate(_):
-        migrate()
+    def migrate(_=None):
+        try:
+            migrate()
+        except MigrationError as error:
+            log.error(f'Migration failed: {error}')
+            sys.exit(1)
+
+    @staticmethod
+    def check_migrations(_):
+        if not check():
+            sys.exit(1)
 
     def add_peer(self, args):
         if args.self:
@@ -166,4 +183,14 @@ class Main:
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    # Validation workers import this module too, modules loading settings are
+    # only imported by the node itself
+    from sharing import ShareManager, PeerManager, Peer
+    from blockchain import Database, ChainRegistry
+    from scripts.migrate import migrate, check, MigrationError
+    from utils import settings, log
+    from manage import ManageClient, run_rpc_server
+
     Main().run(sys.argv[1:])
@@ -4,7 +4,6 @@ import string
 import getpass
 import random
 
-from calendar import timegm
 from threading import Thread
 from concurrent import futures
 
@@ -34,9 +33,14 @@ class ManageServer(ManageServicer):
 
     @staticmethod
     def peers(_):
-        for peer in ShareManager().servers + ShareManager().clients:
+        # Peers are changed on the event loop of peers only
+        for peer in ShareManager().submit(ShareManager().connected_peers()).result(timeout=10):
             yield Result(line=f'{peer}')
 
+        async def seen():
+            return f'{ShareManager().seen}'
+        yield Result(line=f'Broadcasts: {ShareManager().submit(seen()).result(timeout=10)}')
+
     @staticmethod
     def create_chain(args):
         chain = Blockchain.create(
@@ -114,7 +118,7 @@ class BlockchainServer(BlockchainServicer):
                             block_hash=block.block_hash,
                             prev_hash=block.prev_hash,
                             signature=block.signature,
-                            time=timegm(block.time.timetuple()),
+                            time=block.timestamp,
                             height=block.height
                         )
                 except ValueError:
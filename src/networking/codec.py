@@ -0,0 +1,262 @@
+"""
+Compact binary encoding of messages, used with peers which announced it in Info.
+
+Frame:  MAGIC | type index(1 byte) | identifier(str) | content(value)
+
+Values are tagged, integers are zigzag varints. Dict keys in `KEYS` take one byte,
+values of `BASE58_FIELDS` are sent as raw bytes (32-byte hashes, DER signatures,
+public keys) and encoded back to the same base58 strings when loading.
+"""
+
+import zlib
+import struct
+
+from base58 import b58decode
+
+MAGIC = b'\xb1'
+# Frame of a zlib compressed JSON or binary frame
+COMPRESSED = b'\xb2'
+
+NONE, FALSE, TRUE, INT, STR, BASE58, LIST, DICT, FLOAT = range(9)
+
+KEYS = ('type', 'hash', 'prev_hash', 'time', 'signature', 'chain_id', 'height', 'payload',
+        'blocks', 'end', 'from', 'to', 'count', 'peers', 'address', 'port', 'version', 'chains',
+        'platform', 'full_node', 'digest', 'formats', 'code', 'desc', 'prefixes', 'nodes',
+        'system', 'node', 'public_key', 'compression', 'retry_after')
+KEY_INDEXES = {key: index + 1 for index, key in enumerate(KEYS)}
+
+BASE58_FIELDS = frozenset(('hash', 'prev_hash', 'signature', 'chain_id', 'public_key'))
+
+DOUBLE = struct.Struct('>d')
+
+ALPHABET = b'123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+# Two base58 digits per division, loading is bound by encoding hashes back to base58
+PAIRS = [bytes((ALPHABET[i // 58], ALPHABET[i % 58])) for i in range(58 * 58)]
+
+
+# Longest varint, enough for 64-bit integers
+VARINT_BYTES = 10
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class Encoded(bytes):
+    """
+    A value already encoded by `dump_value`, it is spliced into the output as is
+    """
+
+
+def dump(type_index: int, identifier: str, content) -> bytes:
+    return dump_header(type_index, identifier) + dump_value(content)
+
+
+def dump_header(type_index: int, identifier: str) -> bytes:
+    out = bytearray(MAGIC)
+    out.append(type_index)
+    _dump_str(identifier, out)
+    return bytes(out)
+
+
+def dump_value(value) -> bytes:
+    """
+    :return: encoded value, a frame is its header followed by encoded content
+    """
+    out = bytearray()
+    _dump(value, out)
+    return bytes(out)
+
+
+def load(data) -> tuple:
+    """
+    :param data: bytes of a binary frame
+    :return: (type index, identifier, content)
+    """
+    data = bytes(data)
+    if data[:1] != MAGIC or len(data) < 2:
+        raise DecodeError('Not a binary frame')
+    try:
+        identifier, position = _load_str(data, 2)
+        content, position = _load(data, position)
+    except (IndexError, UnicodeDecodeError, struct.error, RecursionError) as error:
+        raise DecodeError(f'{error}')
+    if position != len(data):
+        raise DecodeError('Trailing bytes')
+    return data[1], identifier, content
+
+
+def compress(data, level: int) -> bytes:
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    return COMPRESSED + zlib.compress(data, level)
+
+
+def decompress(data, limit: int) -> bytes:
+    """
+    :param data: bytes of a compressed frame
+    :param limit: max size after decompression
+    :return: bytes of the inner frame
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(bytes(data[1:]), limit)
+    except zlib.error as error:
+        raise DecodeError(f'{error}')
+    if len(decompressor.unconsumed_tail) > 0:
+        raise DecodeError(f'Frame is larger than {limit} bytes after decompression')
+    if not decompressor.eof:
+        raise DecodeError('Truncated compressed frame')
+    return result
+
+
+def _dump_varint(n: int, out: bytearray):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _dump_str(value: str, out: bytearray):
+    data = value.encode('utf8')
+    _dump_varint(len(data), out)
+    out += data
+
+
+def _base58(value: str):
+    # Only strings which come back exactly are sent as raw bytes
+    try:
+        raw = b58decode(value)
+    except ValueError:
+        return None
+    return raw if _b58encode(raw) == value else None
+
+
+def _b58encode(raw: bytes) -> str:
+    n = int.from_bytes(raw, 'big')
+    digits = []
+    while n > 0:
+        n, r = divmod(n, 58 * 58)
+        digits.append(PAIRS[r])
+    digits.reverse()
+    zeros = len(raw) - len(raw.lstrip(b'\0'))
+    return '1' * zeros + b''.join(digits).lstrip(b'1').decode('ascii')
+
+
+def _dump(value, out: bytearray, key: str = None):
+    if isinstance(value, Encoded):
+        out += value
+    elif value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        out.append(INT)
+        _dump_varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, str):
+        raw = _base58(value) if key in BASE58_FIELDS and len(value) > 0 else None
+        if raw is not None:
+            out.append(BASE58)
+            _dump_varint(len(raw), out)
+            out += raw
+        else:
+            out.append(STR)
+            _dump_str(value, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        _dump_varint(len(value), out)
+        for item in value:
+            _dump(item, out)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        _dump_varint(len(value), out)
+        for k, v in value.items():
+            index = KEY_INDEXES.get(k)
+            if index is not None:
+                out.append(index)
+            else:
+                out.append(0)
+                _dump_str(k, out)
+            _dump(v, out, k)
+    else:
+        raise TypeError(f'{type(value)} can not be encoded')
+
+
+def _load_varint(data: bytes, position: int) -> tuple:
+    result = 0
+    shift = 0
+    for _ in range(VARINT_BYTES):
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+    raise DecodeError(f'Varint longer than {VARINT_BYTES} bytes')
+
+
+def _load_count(data: bytes, position: int) -> tuple:
+    # Every item takes one byte at least, a larger count is not looped over
+    count, position = _load_varint(data, position)
+    if count > len(data) - position:
+        raise DecodeError(f'Count {count} exceeds remaining bytes')
+    return count, position
+
+
+def _load_str(data: bytes, position: int) -> tuple:
+    size, position = _load_varint(data, position)
+    end = position + size
+    if end > len(data):
+        raise DecodeError('Truncated string')
+    return data[position:end].decode('utf8'), end
+
+
+def _load(data: bytes, position: int) -> tuple:
+    tag = data[position]
+    position += 1
+    if tag == NONE:
+        return None, position
+    if tag == TRUE:
+        return True, position
+    if tag == FALSE:
+        return False, position
+    if tag == INT:
+        n, position = _load_varint(data, position)
+        return (n >> 1) if n & 1 == 0 else -((n + 1) >> 1), position
+    if tag == FLOAT:
+        return DOUBLE.unpack_from(data, position)[0], position + DOUBLE.size
+    if tag == STR:
+        return _load_str(data, position)
+    if tag == BASE58:
+        size, position = _load_varint(data, position)
+        end = position + size
+        if end > len(data):
+            raise DecodeError('Truncated bytes')
+        return _b58encode(data[position:end]), end
+    if tag == LIST:
+        count, position = _load_count(data, position)
+        result = []
+        for _ in range(count):
+            item, position = _load(data, position)
+            result.append(item)
+        return result, position
+    if tag == DICT:
+        count, position = _load_count(data, position)
+        result = {}
+        for _ in range(count):
+            index = data[position]
+            position += 1
+            if index == 0:
+                key, position = _load_str(data, position)
+            elif index <= len(KEYS):
+                key = KEYS[index - 1]
+            else:
+                raise DecodeError(f'Unknown key index {index}')
+            result[key], position = _load(data, position)
+        return result, position
+    raise DecodeError(f'Unknown tag {tag}')
@@ -1,29 +1,171 @@
+import asyncio
+
 from .message import Message
-from typing import Any
+from .stats import PeerStats
+from typing import Any, Optional
 from dataclasses import dataclass, field
 
-from utils import log
+from utils import settings, log
+
+
+class Pending:
+    """
+    A question waiting for answers.
+
+    `await pending` gives the next answer, `async for` gives answers until the
+    question is finished. Both end with None when the deadline passes or the peer
+    is closed. The deadline is extended by every answer, so a long multi-part
+    answer only expires when it stalls.
+    """
+
+    def __init__(self, identifier: str, callback=None, multiple: bool = False, timeout: float = None):
+        self.identifier = identifier
+        self.callback = callback
+        self.multiple = multiple
+        self.timeout = timeout if timeout is not None else settings.peers.timeout
+        self.deadline = asyncio.get_event_loop().time() + self.timeout
+        self.answers = asyncio.Queue()
+        self.finished = False
+        self.dispatcher = None
+        self.sent = asyncio.get_event_loop().time()
+        self.last = None
+        # Bytes of answers received
+        self.received = 0
+
+    @property
+    def is_expired(self) -> bool:
+        return asyncio.get_event_loop().time() > self.deadline
+
+    def feed(self, message: Message):
+        self.last = asyncio.get_event_loop().time()
+        self.deadline = self.last + self.timeout
+        # Answers are handed to callback instead if there is one
+        if self.callback is None:
+            self.answers.put_nowait(message)
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        # Wake up anyone waiting for an answer
+        self.answers.put_nowait(None)
+        if self.dispatcher is not None:
+            self.dispatcher.remove(self)
+
+    async def answer(self) -> Optional[Message]:
+        if self.finished and self.answers.empty():
+            return None
+        try:
+            remain = max(self.deadline - asyncio.get_event_loop().time(), 0)
+            return await asyncio.wait_for(self.answers.get(), remain)
+        except asyncio.TimeoutError:
+            # A question expired by the dispatcher is finished already, it is counted there
+            if not self.finished and self.dispatcher is not None:
+                self.dispatcher.stats.timeout()
+            self.finish()
+            return None
+
+    def __await__(self):
+        return self.answer().__await__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Message:
+        message = await self.answer()
+        if message is None:
+            raise StopAsyncIteration
+        return message
 
 
 @dataclass
 class Dispatcher:
     handlers: dict = field(default_factory=dict)
     global_handler: Any = None
+    # Count of questions waiting for answers, asking more waits for a free slot
+    limit: int = field(default_factory=lambda: settings.peers.requests)
+    waiters: list = field(default_factory=list)
+    stats: PeerStats = field(default_factory=PeerStats)
+
+    async def register(self, identifier, callback=None, multiple: bool = False, timeout: float = None) -> Pending:
+        """
+        :param identifier: identifier of the question
+        :param callback: called with (message, peer) for every answer, question is finished when it returns True
+        :param multiple: question without callback expects more than one answer, it is finished by caller
+        :param timeout: seconds to wait for each answer
+        :return: Pending of the question
+        """
+        self.expire()
+        loop = asyncio.get_event_loop()
+        while len(self.handlers) >= self.limit:
+            waiter = loop.create_future()
+            self.waiters.append(waiter)
+            deadline = min(pending.deadline for pending in self.handlers.values())
+            await asyncio.wait([waiter], timeout=max(deadline - loop.time(), 0))
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            self.expire()
+
+        pending = Pending(identifier, callback, multiple, timeout)
+        pending.dispatcher = self
+        self.handlers[identifier] = pending
+        return pending
+
+    # Answers smaller than it measure latency rather than throughput
+    THROUGHPUT_SAMPLE = 64 * 1024
+
+    def remove(self, pending: Pending):
+        if self.handlers.get(pending.identifier) is pending:
+            del self.handlers[pending.identifier]
+        if pending.received >= self.THROUGHPUT_SAMPLE:
+            self.stats.downloaded(pending.received, pending.last - pending.sent)
+        while len(self.waiters) > 0:
+            waiter = self.waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def expire(self):
+        for pending in [pending for pending in self.handlers.values() if pending.is_expired]:
+            log.debug(f'Question {pending.identifier} expired')
+            self.stats.timeout()
+            pending.finish()
+
+    def close(self):
+        """
+        Finish every question, called when the peer is disconnected
+        """
+        for pending in list(self.handlers.values()):
+            pending.finish()
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters = []
 
-    def register(self, identifier, handler):
-        self.handlers[identifier] = handler
-
-    # TODO: May need a timeout to clean the handlers list
-    async def dispatch(self, message: Message, peer):
-        handler = self.handlers.get(message.identifier)
-        if handler is not None:
-            try:
-                result = await handler(message, peer)
-            except TypeError:
-                result = handler(message, peer)
-            if result:
-                del self.handlers[message.identifier]
+    async def dispatch(self, message: Message, peer, size: int = 0):
+        """
+        :param message: message received
+        :param peer: peer sent the message
+        :param size: size of the frame, for measuring throughput
+        """
+        pending = self.handlers.get(message.identifier)
+        if pending is not None:
+            if pending.last is None:
+                self.stats.answered(asyncio.get_event_loop().time() - pending.sent)
+            if message.type == Message.Type.ERROR:
+                self.stats.error()
+            pending.received += size
+            pending.feed(message)
+            if pending.callback is not None:
+                result = pending.callback(message, peer)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                if result:
+                    pending.finish()
+            elif not pending.multiple:
+                pending.finish()
         elif self.global_handler is not None:
             await self.global_handler(message, peer)
         else:
             log.warning('Missing gloabel handler for receiving messages.')
+        self.expire()
@@ -0,0 +1,77 @@
+from time import monotonic
+from utils import settings
+
+
+class TokenBucket:
+    """
+    Tokens refill at `rate` per second up to `burst`.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = monotonic()
+
+    def __refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def take(self, amount: float = 1) -> float:
+        """
+        Take tokens only if there are enough
+
+        :return: 0 if taken, otherwise seconds until there will be enough
+        """
+        self.__refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> float:
+        """
+        Take tokens even if it runs into debt
+
+        :return: seconds to wait until the debt is paid
+        """
+        self.__refill()
+        self.tokens -= amount
+        return self.delay
+
+    @property
+    def is_full(self) -> bool:
+        """
+        :return: True if the bucket is the same as a new one
+        """
+        self.__refill()
+        return self.tokens >= self.burst
+
+    @property
+    def delay(self) -> float:
+        """
+        :return: seconds until the bucket is out of debt
+        """
+        self.__refill()
+        return max(0.0, -self.tokens / self.rate)
+
+
+class PeerLimits:
+    """
+    Questions and bytes this node serves to a peer address, they outlive
+    connections so reconnecting does not refill them.
+    """
+
+    def __init__(self):
+        self.questions = TokenBucket(settings.limits.questions, settings.limits.questions_burst)
+        self.served = TokenBucket(settings.limits.bytes, settings.limits.bytes_burst)
+        # Ranges of blocks being served
+        self.serving = 0
+
+    @property
+    def is_idle(self) -> bool:
+        """
+        :return: True if limits are fully refilled, dropping them changes nothing
+        """
+        return self.serving == 0 and self.questions.is_full and self.served.is_full
@@ -4,6 +4,39 @@ from enum import Enum
 from json import JSONDecoder, JSONEncoder, JSONDecodeError
 from random import choices
 from dataclasses import dataclass, field
+from . import codec
+from utils import settings
+
+
+class EncodedContent:
+    """
+    Content of messages encoded once for each format, it is spliced into frames
+    of any identifier and message type without being encoded again.
+    """
+    __slots__ = ('__json', '__binary')
+
+    def __init__(self, json, binary=None):
+        """
+        :param json: canonical JSON of content, or a function building it on first use
+        :param binary: binary encoding of content, or a function building it on first use,
+                       it is encoded from the JSON if not given
+        """
+        self.__json = json
+        self.__binary = binary
+
+    @property
+    def json(self) -> bytes:
+        if callable(self.__json):
+            self.__json = self.__json()
+        return self.__json
+
+    @property
+    def binary(self) -> bytes:
+        if self.__binary is None:
+            self.__binary = codec.dump_value(JSONDecoder().decode(bytes(self.json).decode('utf8')))
+        elif callable(self.__binary):
+            self.__binary = self.__binary()
+        return self.__binary
 
 
 @dataclass
@@ -14,14 +47,36 @@ class Message:
         ANSWER = 'answer'
         ERROR = 'error'
 
+    # Wire formats this node can load, in order of preference
+    FORMATS = ('binary', 'json')
+
     content: dict = None
     type: Type = Type.QUESTION
     identifier: str = field(default_factory=lambda: ''.join(choices(string.digits + string.ascii_letters, k=10)))
+    # Type of sentence in content, decides if it is worth compressing
+    content_type: str = None
 
     @classmethod
-    def load(cls, json_string):
+    def load(cls, data):
+        """
+        :param data: a JSON text frame, or a binary or compressed frame as bytes
+        :return: Message, or None if data is broken
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:1]) == codec.COMPRESSED:
+            try:
+                data = codec.decompress(data, settings.compression.max_size)
+            except ValueError:
+                return None
+        if isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:1]) == codec.MAGIC:
+            try:
+                type_index, identifier, content = codec.load(data)
+                return Message(content, list(cls.Type)[type_index], identifier)
+            except (IndexError, ValueError):
+                return None
         try:
-            json = JSONDecoder().decode(json_string)
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                data = bytes(data).decode('utf8')
+            json = JSONDecoder().decode(data)
             msg = Message()
             msg.identifier = json['identifier']
             msg.type = cls.Type(json['type'])
@@ -30,13 +85,67 @@ class Message:
         except (KeyError, ValueError, JSONDecodeError):
             return None
 
-    def dump(self) -> str:
+    def dump(self, binary: bool = False, compress: bool = False):
+        """
+        :param binary: encode into a binary frame, only for peers which can load it
+        :param compress: compress the frame if its content type is set to be compressed
+        :return: str of JSON, or bytes of binary or compressed frame
+        """
+        data = self.__dump(binary)
+        if compress and self.content_type in settings.compression.types \
+                and len(data) >= settings.compression.min_size:
+            return codec.compress(data, settings.compression.level)
+        return data
+
+    def __dump(self, binary: bool):
+        content = self.content
+        if binary:
+            type_index = list(self.Type).index(self.type)
+            if isinstance(content, EncodedContent):
+                return codec.dump_header(type_index, self.identifier) + content.binary
+            if isinstance(content, (bytes, bytearray)):
+                content = JSONDecoder().decode(content.decode('utf8'))
+            return codec.dump(type_index, self.identifier, content)
+
         json = {
             'identifier': self.identifier,
-            'type': self.type.value,
-            'content': self.content
+            'type': self.type.value
         }
+        if isinstance(content, EncodedContent):
+            content = content.json
+        # Content may be pre-encoded JSON bytes, splice it into the frame as is
+        if isinstance(content, (bytes, bytearray)):
+            header = JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode(json)
+            return header[:-1] + ',"content":' + content.decode('utf8') + '}'
+        json['content'] = content
         return JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode(json)
 
     def __repr__(self):
         return f'<Message: {self.identifier} - {self.type}>'
+
+
+class Frame:
+    """
+    A message encoded once for each wire format, the same buffer is sent to every
+    peer using that format. `Peer.send` and `Peer.post` take it in place of a Message.
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        # (binary, compress) -> encoded frame
+        self.__encoded = {}
+
+    @property
+    def identifier(self) -> str:
+        return self.message.identifier
+
+    def dump(self, binary: bool = False, compress: bool = False):
+        key = (binary, compress)
+        data = self.__encoded.get(key)
+        if data is None:
+            data = self.message.dump(binary, compress)
+            self.__encoded[key] = data
+        return data
+
+    def __repr__(self):
+        return f'<Frame: {self.message}>'
@@ -1,12 +1,17 @@
+import os
+import json
 import asyncio
+import tempfile
 import websockets
 import websockets.client
 
-from .message import Message
-from .dispatcher import Dispatcher
-from dataclasses import dataclass
-from typing import Any
-from utils import Singleton, settings
+from .message import Message, Frame
+from .dispatcher import Dispatcher, Pending
+from .stats import PeerStats
+from threading import Lock
+from dataclasses import dataclass, field
+from typing import Any, Optional, Union
+from utils import Singleton, settings, StorageExecutor
 from pymongo import MongoClient, ASCENDING, DESCENDING
 
 from utils import log
@@ -18,11 +23,23 @@ class Peer:
     port: int = 80
     rank: int = 100
     socket: Any = None
-    dispatcher: Dispatcher = Dispatcher()
+    dispatcher: Dispatcher = field(default_factory=Dispatcher)
     is_server: bool = True
     peer_in: Any = None
     peer_out: Any = None
     retry_count: int = 0
+    # Peer announced it can load binary frames
+    binary: bool = False
+    # Peer announced it can load compressed frames
+    compression: bool = False
+    # Version of Info the peer announced on this connection
+    version: str = None
+    # Seconds the peer asked to wait before asking it again
+    retry_after: float = 0
+    # Encoded messages waiting to be written by `write`, created for each connection
+    outbox: Any = None
+    # Messages dropped in a row because outbox is full
+    dropped: int = 0
 
     @property
     def dict(self):
@@ -31,6 +48,31 @@ class Peer:
             'port': self.port
         }
 
+    @property
+    def content_limit(self) -> int:
+        """
+        :return: size of content a sentence may carry to this peer
+        """
+        if self.compression:
+            # Compressed frames are limited after decompression, keep room for framing
+            return settings.compression.max_size * 3 // 4
+        return int(2**20 * 1.5)
+
+    @property
+    def stats(self) -> PeerStats:
+        return self.dispatcher.stats
+
+    @property
+    def score(self) -> float:
+        return self.stats.score if self.stats.has_samples else float(self.rank)
+
+    def update_rank(self):
+        """
+        Move rank towards the score measured on this connection
+        """
+        if self.stats.has_samples:
+            self.rank = round(self.rank + (self.stats.score - self.rank) * PeerStats.ALPHA)
+
     @property
     def is_connected(self) -> bool:
         return self.socket is not None
@@ -43,10 +85,9 @@ class Peer:
         peer.is_server = False
         return peer
 
-    def open(self):
+    async def open(self):
         log.info(f'Connecting (count: {self.retry_count + 1}) {self}')
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        asyncio.get_event_loop().run_until_complete(self.catched())
+        await self.catched()
 
     async def catched(self):
         try:
@@ -57,6 +98,9 @@ class Peer:
             log.debug(f'Disconnected from {self}: {msg}')
         finally:
             self.socket = None
+            self.outbox = None
+            self.dropped = 0
+            self.dispatcher.close()
             if self.peer_out is not None:
                 await self.peer_out(self)
 
@@ -64,31 +108,159 @@ class Peer:
         if not self.is_server:
             if self.peer_in is not None:
                 await self.peer_in(self)
-            await self.recv()
+            await self.serve()
             return
         host = f'ws://{self.address}:{self.port}'
-        async with websockets.connect(host, max_size=2**21) as socket:
+        # Compression is chosen per message type by peers, not applied to every frame by websockets,
+        # pings are sent by `keepalive` to measure the peer
+        async with websockets.connect(host, max_size=settings.compression.max_size,
+                                      compression=None, ping_interval=None) as socket:
             self.socket = socket
             if self.peer_in is not None:
                 await self.peer_in(self)
+            await self.serve()
+
+    async def serve(self):
+        keepalive = asyncio.ensure_future(self.keepalive())
+        writer = asyncio.ensure_future(self.write())
+        try:
             await self.recv()
+        finally:
+            keepalive.cancel()
+            writer.cancel()
+
+    def post(self, message: Union[Message, Frame]) -> bool:
+        """
+        Queue a message without waiting, for messages sent to many peers at once.
+        The oldest one is dropped when the queue is full, a peer dropping
+        too many in a row is disconnected.
 
-    async def send(self, message: Message, callback=None):
+        :return: False if a message is dropped
+        """
         if self.socket is None:
-            return
+            return False
+        if self.outbox is None:
+            self.outbox = asyncio.Queue(settings.peers.outbox)
+        data = message.dump(self.binary, self.compression)
+        if not self.outbox.full():
+            self.outbox.put_nowait(data)
+            return True
+
+        self.outbox.get_nowait()
+        self.outbox.put_nowait(data)
+        self.dropped += 1
+        log.debug(f'Outbox of {self} is full, {self.dropped} messages dropped')
+        if self.dropped == settings.peers.drops:
+            log.warning(f'Disconnect {self}: too slow to receive messages')
+            self.disconnect()
+        return False
+
+    def disconnect(self):
+        if self.socket is not None:
+            asyncio.ensure_future(self.socket.close())
+
+    async def write(self):
+        """
+        Write messages queued by `post`, a stalled peer only holds back its own queue
+        """
+        if self.outbox is None:
+            self.outbox = asyncio.Queue(settings.peers.outbox)
+        outbox = self.outbox
+        while True:
+            data = await outbox.get()
+            socket = self.socket
+            if socket is None:
+                return
+            try:
+                await asyncio.wait_for(socket.send(data), settings.peers.timeout)
+                self.dropped = 0
+            except asyncio.TimeoutError:
+                log.warning(f'Disconnect {self}: writing timed out')
+                self.stats.timeout()
+                self.disconnect()
+                return
+            except websockets.ConnectionClosed:
+                return
+
+    async def keepalive(self):
+        """
+        Ping the peer periodically, round trip time and timeouts are taken into its score,
+        the peer is disconnected after `settings.peers.pings` pings in a row are not answered
+        """
+        loop = asyncio.get_event_loop()
+        missed = 0
+        while True:
+            await asyncio.sleep(settings.peers.ping)
+            socket = self.socket
+            if socket is None:
+                return
+            start = loop.time()
+            try:
+                pong = await socket.ping()
+                await asyncio.wait_for(pong, settings.peers.timeout)
+                self.stats.answered(loop.time() - start)
+                missed = 0
+            except asyncio.TimeoutError:
+                log.debug(f'Ping timeout {self}')
+                self.stats.timeout()
+                missed += 1
+                if missed >= settings.peers.pings:
+                    # Half-open connection, nothing comes back
+                    log.warning(f'Disconnect {self}: {missed} pings not answered')
+                    self.disconnect()
+                    return
+            except websockets.ConnectionClosed:
+                return
+            self.update_rank()
+            if self.is_server:
+                await StorageExecutor().run(self.save)
+
+    async def send(self, message: Union[Message, Frame], callback=None) -> Optional[Pending]:
+        """
+        :param message: message, or frame encoded once for many peers
+        :param callback: called with (message, peer) for answers until it returns True
+        :return: Pending of answers if a callback is given
+        """
         if callback is not None:
-            self.dispatcher.register(message.identifier, callback)
+            return await self.request(message, callback)
+        if self.socket is None:
+            return None
         # log.debug(f'Sending: {message} to {self}')
-        await self.socket.send(message.dump())
+        await self.socket.send(message.dump(self.binary, self.compression))
+        return None
+
+    async def request(self, message: Union[Message, Frame], callback=None, multiple: bool = False,
+                      timeout: float = None) -> Optional[Pending]:
+        """
+        Send a question and wait for answers with the returned Pending,
+        it waits first if too many questions are not answered yet.
+        Never await it while handling a message of the same peer, answers freeing
+        a slot are read by that very loop, run it as a task instead.
+
+        :param message: question
+        :param callback: see `Dispatcher.register`
+        :param multiple: see `Dispatcher.register`
+        :param timeout: seconds to wait for each answer
+        :return: Pending of answers, None if not connected
+        """
+        if self.socket is None:
+            return None
+        pending = await self.dispatcher.register(message.identifier, callback, multiple, timeout)
+        if self.socket is None:
+            pending.finish()
+            return None
+        await self.socket.send(message.dump(self.binary, self.compression))
+        return pending
 
     async def recv(self):
         async for data in self.socket:
             msg = Message.load(data)
             if msg is not None:
                 # log.debug(f'Received: {msg} from {self}')
-                await self.dispatcher.dispatch(msg, self)
+                await self.dispatcher.dispatch(msg, self, len(data))
             else:
                 log.warning(f'Bad message:\n{data}')
+                self.stats.error()
                 self.rank -= 1
 
     def save(self):
@@ -99,56 +271,99 @@ class Peer:
             return True
         return False
 
+    def __hash__(self):
+        return hash((self.address, self.port))
+
     def __repr__(self):
-        return f'<Peer{"(server)" if self.is_server else "(client)"}: {self.address}:{self.port} (rank: {self.rank})>'
+        return f'<Peer{"(server)" if self.is_server else "(client)"}: {self.address}:{self.port} ' \
+               f'(rank: {self.rank}, score: {self.score:.01f})>'
 
 
 class PeerManager(metaclass=Singleton):
 
     def __init__(self):
         db_settings = settings.database
-        self.database = MongoClient(db_settings.host, db_settings.port)[db_settings.name]
+        self.database = None
+        # Peers are kept in a json file when running with embedded storage engine
+        self.__path = None
+        self.__peers = {}
+        # Peers are saved from storage threads
+        self.__lock = Lock()
+        if db_settings.engine == 'embedded':
+            os.makedirs(os.path.expanduser(db_settings.path), exist_ok=True)
+            self.__path = os.path.join(os.path.expanduser(db_settings.path), 'peers.json')
+            if os.path.isfile(self.__path):
+                with open(self.__path, 'r') as file:
+                    self.__peers = {peer['address']: peer for peer in json.load(file)}
+        else:
+            self.database = MongoClient(db_settings.host, db_settings.port)[db_settings.name]
+        self.__count = None
 
     @property
     def count(self) -> int:
-        return len(self.all_peers())
+        if self.__count is None:
+            self.__count = len(self.__peers) if self.database is None else self.database.peers.count_documents({})
+        return self.__count
 
     def all_peers(self) -> [Peer]:
-        return [Peer(peer['address'], peer['port'], peer['rank']) for peer in self.database.peers.find()]
+        if self.database is None:
+            with self.__lock:
+                documents = list(self.__peers.values())
+        else:
+            documents = self.database.peers.find()
+        return [Peer(peer['address'], peer['port'], peer['rank']) for peer in documents]
 
     def peers(self, count=10, without_self=False, min_rank=0) -> [Peer]:
-        query = {'rank': {'$gt': min_rank}}
-        if without_self:
-            query['address'] = {
-                '$nin': [settings.server.address, '0.0.0.0', 'localhost', '127.0.0.1']
-            }
-        result = self.database.peers.find(query).sort('rank', DESCENDING).limit(count)
+        excluded = [settings.server.address, '0.0.0.0', 'localhost', '127.0.0.1']
+        if self.database is None:
+            with self.__lock:
+                documents = list(self.__peers.values())
+            result = [peer for peer in documents
+                      if peer['rank'] > min_rank and not (without_self and peer['address'] in excluded)]
+            result = sorted(result, key=lambda peer: peer['rank'], reverse=True)[:count]
+        else:
+            query = {'rank': {'$gt': min_rank}}
+            if without_self:
+                query['address'] = {'$nin': excluded}
+            result = self.database.peers.find(query).sort('rank', DESCENDING).limit(count)
         return [Peer(peer['address'], peer['port'], peer['rank']) for peer in result]
 
     def add_peer(self, peer: Peer):
-        return self.database.peers.update_one(
+        if self.database is None:
+            with self.__lock:
+                self.__peers[peer.address] = {'address': peer.address, 'port': peer.port, 'rank': peer.rank}
+                self.__write()
+                self.__count = len(self.__peers)
+            return None
+        result = self.database.peers.update_one(
             {'address': peer.address},
             {'$set': {'address': peer.address, 'port': peer.port, 'rank': peer.rank}},
             upsert=True
         )
+        if result.upserted_id is not None and self.__count is not None:
+            self.__count += 1
+        return result
+
+    def __write(self):
+        # A unique temporary file in the same directory, replaced atomically
+        fd, temp = tempfile.mkstemp(prefix='peers.', suffix='.tmp', dir=os.path.dirname(self.__path))
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(list(self.__peers.values()), file)
+            os.replace(temp, self.__path)
+        except BaseException:
+            os.unlink(temp)
+            raise
 
     def migrate(self):
+        if self.database is None:
+            return
         log.info('Create index for "address" in "peers".')
         self.database.peers.create_index([('address', ASCENDING)], unique=True)
 
     def __repr__(self):
-        result = self.database.peers.aggregate(
-            [{
-                '$group': {
-                    '_id': '$by_user',
-                    'rank': {
-                        '$avg': '$rank'
-                    }
-                }
-            }]
-        )
-        result = list(result)
-        if len(result) == 0:
+        peers = self.all_peers()
+        if len(peers) == 0:
             return '<PeerManager: No Peers>'
-        arrange_rank = result[0]['rank']
-        return "<PeerManager: %d peers, rank %.02f(avg.)>" % (self.count, arrange_rank)
+        arrange_rank = sum(peer.rank for peer in peers) / len(peers)
+        return "<PeerManager: %d peers, rank %.02f(avg.)>" % (len(peers), arrange_rank)
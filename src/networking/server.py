@@ -1,4 +1,3 @@
-import asyncio
 import websockets
 
 from typing import Any
@@ -12,20 +11,26 @@ from utils import settings, log
 class Server:
     peer_in: Any = None
     peer_out: Any = None
+    # Coroutine function with a new peer, returns False to turn the peer away
+    admit: Any = None
 
-    def start(self):
+    async def start(self):
+        """
+        Start listening on the running event loop
+        """
         log.info(f'Start server {settings.server.address}:{settings.server.port}')
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        server = websockets.serve(self.handle, '0.0.0.0', settings.server.port, max_size=2**21)
         try:
-            asyncio.get_event_loop().run_until_complete(server)
-            asyncio.get_event_loop().run_forever()
+            return await websockets.serve(self.handle, '0.0.0.0', settings.server.port,
+                                          max_size=settings.compression.max_size,
+                                          compression=None, ping_interval=None)
         except OSError as error:
             log.error(error)
 
     async def handle(self, socket, _):
-        # TODO: Limit number of connections
         peer = Peer.from_client(socket)
+        if self.admit is not None and not await self.admit(peer):
+            await socket.close()
+            return
         peer.peer_in = self.peer_in
         peer.peer_out = self.peer_out
         await peer.catched()
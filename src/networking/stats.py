@@ -0,0 +1,67 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class PeerStats:
+    """
+    Responding speed and stability of a connected peer.
+
+    Every measure is an exponential moving average, so recent behaviour
+    weighs more and an old failure fades away.
+    """
+    # Weight of a new sample
+    ALPHA = 0.2
+    # Round trip time considered as half good
+    RTT_REFERENCE = 0.5
+    # Download speed (bytes/sec) considered as half good
+    THROUGHPUT_REFERENCE = 256 * 1024
+
+    rtt: float = None
+    throughput: float = None
+    # Rate of failed (error or timed out) requests
+    failure: float = 0.0
+    errors: int = 0
+    timeouts: int = 0
+
+    @classmethod
+    def __average(cls, old, sample):
+        return sample if old is None else old + (sample - old) * cls.ALPHA
+
+    @property
+    def has_samples(self) -> bool:
+        return self.rtt is not None or self.errors > 0 or self.timeouts > 0
+
+    def answered(self, rtt: float):
+        self.rtt = self.__average(self.rtt, rtt)
+        self.failure = self.__average(self.failure, 0.0)
+
+    def downloaded(self, size: int, seconds: float):
+        if seconds > 0:
+            self.throughput = self.__average(self.throughput, size / seconds)
+
+    def error(self):
+        self.errors += 1
+        self.failure = self.__average(self.failure, 1.0)
+
+    def timeout(self):
+        self.timeouts += 1
+        self.failure = self.__average(self.failure, 1.0)
+
+    @property
+    def score(self) -> float:
+        """
+        :return: 0 (useless) to 100 (fast and stable)
+        """
+        factors = []
+        if self.rtt is not None:
+            factors.append(self.RTT_REFERENCE / (self.RTT_REFERENCE + self.rtt))
+        if self.throughput is not None:
+            factors.append(self.throughput / (self.throughput + self.THROUGHPUT_REFERENCE))
+        speed = sum(factors) / len(factors) if len(factors) > 0 else 0.5
+        # Speed counts only if the peer answers at all
+        return 100 * (1 - self.failure) * (0.5 + 0.5 * speed)
+
+    def __repr__(self):
+        rtt = 'n/a' if self.rtt is None else '%.0fms' % (self.rtt * 1000)
+        throughput = 'n/a' if self.throughput is None else '%.0fKB/s' % (self.throughput / 1024)
+        return f'<PeerStats: rtt {rtt}, {throughput}, failure {self.failure:.02f}, score {self.score:.01f}>'
@@ -1,10 +1,8 @@
 # import random
 # import string
-import asyncio
-
-from threading import Thread
 from datetime import datetime
 # from blockchain import Blockchain
+from blockchain import AppendResult
 from sharing import ShareManager, SentenceFactory
 from utils import log
 
@@ -34,14 +32,13 @@ def create_block(chain, payload):
     log.info("Create a random content block in %.03f secs" % (end - start).total_seconds())
 
     start = datetime.utcnow()
-    if not chain.save_block(block):
+    result = chain.save_block(block)
+    if result != AppendResult.SAVED:
+        log.warning(f'Failed to save block at height {block.height}: {result.value}')
         return None
     end = datetime.utcnow()
     log.info("Validate & Save a random content block in %.03f secs" % (end - start).total_seconds())
 
-    def __b():
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        asyncio.get_event_loop().run_until_complete(boardcast(chain))
-    Thread(target=__b).start()
+    ShareManager().submit(boardcast(chain))
 
     return block
@@ -1,7 +1,122 @@
-from blockchain import Database
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from blockchain import Database, MongoStorage
 from networking import PeerManager
+from utils import log
 
 
-def migrate():
+class MigrationError(Exception):
+    pass
+
+
+def initial_indexes():
     Database().migrate()
     PeerManager().migrate()
+
+
+def duplicate_heights(blocks) -> dict:
+    """
+    :return: chain_id -> heights having more than one block
+    """
+    pipeline = [
+        {'$group': {'_id': {'chain_id': '$chain_id', 'height': '$height'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$group': {'_id': '$_id.chain_id', 'heights': {'$push': '$_id.height'}}}
+    ]
+    return {group['_id']: sorted(group['heights']) for group in blocks.aggregate(pipeline, allowDiskUse=True)}
+
+
+def compound_block_indexes():
+    blocks = Database().database.blocks
+    duplicates = duplicate_heights(blocks)
+    if len(duplicates) > 0:
+        # Which one of the blocks is linked can not be told here, they are left for the operator
+        for chain_id, heights in duplicates.items():
+            shown = ', '.join(str(height) for height in heights[:10])
+            more = f' and {len(heights) - 10} more' if len(heights) > 10 else ''
+            log.error(f'Chain {chain_id} has more than one block at height {shown}{more}.')
+        raise MigrationError(
+            f'{len(duplicates)} chains have duplicate heights, unique index for "chain_id, height" '
+            f'can not be created. Remove blocks of these chains from the lowest duplicate height '
+            f'and they will be synced again from peers.'
+        )
+    log.info('Create unique index for "chain_id, height" in "blocks".')
+    blocks.create_index([('chain_id', ASCENDING), ('height', ASCENDING)], unique=True)
+    log.info('Create index for "chain_id, hash" in "blocks".')
+    blocks.create_index([('chain_id', ASCENDING), ('hash', ASCENDING)])
+    try:
+        # Covered by the compound index
+        blocks.drop_index([('height', DESCENDING)])
+        log.info('Drop index for "height" in "blocks".')
+    except OperationFailure:
+        pass
+
+
+def peer_rank_index():
+    log.info('Create index for "rank" in "peers".')
+    PeerManager().database.peers.create_index([('rank', DESCENDING)])
+
+
+# Append only, the position in this list is the schema version after applying
+MIGRATIONS = [
+    initial_indexes,
+    compound_block_indexes,
+    peer_rank_index,
+]
+
+
+def schema_version() -> int:
+    meta = Database().database.meta.find_one({'_id': 'schema'})
+    return meta['version'] if meta is not None else 0
+
+
+def migrate():
+    """
+    Apply migrations not applied yet, MigrationError is raised if one of them can not be applied
+    """
+    if not isinstance(Database(), MongoStorage):
+        log.info('Embedded storage engine has no schema to migrate.')
+        return
+
+    version = schema_version()
+    if version >= len(MIGRATIONS):
+        log.info(f'Schema is up to date (version {version}).')
+        return
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        log.info(f'Apply migration {number}: {migration.__name__}')
+        migration()
+        Database().database.meta.update_one({'_id': 'schema'}, {'$set': {'version': number}}, upsert=True)
+
+
+def find_stage(plan, stage) -> bool:
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            return True
+        return any(find_stage(value, stage) for value in plan.values())
+    if isinstance(plan, list):
+        return any(find_stage(value, stage) for value in plan)
+    return False
+
+
+def check() -> bool:
+    """
+    Run explain() on every query of Database and fail if any of them scans whole collection
+
+    :return: all queries are using indexes
+    """
+    if not isinstance(Database(), MongoStorage):
+        log.info('Embedded storage engine reads by offsets, no queries to check.')
+        return True
+
+    chain = Database().database.chains.find_one()
+    chain_id = chain['public_key'] if chain is not None else ''
+
+    passed = True
+    for name, plan in Database().explain_queries(chain_id).items():
+        if find_stage(plan, 'COLLSCAN'):
+            log.error(f'Query `{name}` falls back to a collection scan.')
+            passed = False
+        else:
+            log.info(f'Query `{name}` is using index.')
+    return passed
@@ -0,0 +1,62 @@
+from hashlib import sha256
+
+
+class ChainDigest:
+    """
+    Hash tree over (chain_id, height) of a chain set, used to find chains differ
+    between two nodes without exchanging the whole set.
+
+    Every chain falls in a leaf bucket named by the first `DEPTH` hex digits of
+    sha256(chain_id). Value of a node is XOR of item hashes of all chains under it,
+    so a height change only updates `DEPTH + 1` nodes.
+    """
+    DEPTH = 3
+    DIGITS = '0123456789abcdef'
+
+    def __init__(self, chains: dict = None):
+        # prefix -> XOR of item hashes, '' is the root
+        self.nodes = {}
+        # leaf prefix -> {chain_id: height}
+        self.buckets = {}
+        for chain_id, height in (chains or {}).items():
+            self.update(chain_id, height)
+
+    @classmethod
+    def bucket(cls, chain_id: str) -> str:
+        return sha256(chain_id.encode('utf8')).hexdigest()[:cls.DEPTH]
+
+    @staticmethod
+    def item(chain_id: str, height: int) -> int:
+        return int.from_bytes(sha256(f'{chain_id}:{height}'.encode('utf8')).digest()[:8], 'big')
+
+    def update(self, chain_id: str, height: int):
+        bucket = self.bucket(chain_id)
+        chains = self.buckets.setdefault(bucket, {})
+        change = self.item(chain_id, height)
+        old = chains.get(chain_id)
+        if old is not None:
+            change ^= self.item(chain_id, old)
+        chains[chain_id] = height
+        for i in range(self.DEPTH + 1):
+            self.nodes[bucket[:i]] = self.nodes.get(bucket[:i], 0) ^ change
+
+    def value(self, prefix: str) -> str:
+        return '%016x' % self.nodes.get(prefix, 0)
+
+    @property
+    def root(self) -> str:
+        return self.value('')
+
+    def children(self, prefix: str) -> list:
+        return [self.value(prefix + digit) for digit in self.DIGITS]
+
+    def chains(self, prefix: str) -> dict:
+        return dict(self.buckets.get(prefix, {}))
+
+    def differ(self, prefix: str, children: list) -> list:
+        """
+        :param prefix: prefix of a node
+        :param children: values of children of the node from another digest
+        :return: prefixes of children which are different
+        """
+        return [prefix + digit for digit, value in zip(self.DIGITS, children) if value != self.value(prefix + digit)]
@@ -1,9 +1,19 @@
 from .sentence import *
+from .digest import ChainDigest
 from typing import Optional
+from collections import OrderedDict
 from networking import PeerManager
+from utils import log, StorageExecutor
 
 
 class SentenceFactory:
+    # Answers of recently asked small ranges up to the tip of a chain, a new block
+    # is asked by many peers right after it is broadcast
+    __hot_blocks = OrderedDict()
+    __hot_size = 0
+    # Largest answer cached, and bytes of all answers cached
+    HOT_BLOCKS_SIZE = 64 * 1024
+    HOT_BLOCKS_CAPACITY = 4 * 2**20
 
     @staticmethod
     def load(message: Message):
@@ -27,6 +37,12 @@ class SentenceFactory:
             result = Blocks.load(d)
         elif t == 'new_block':
             result = NewBlock.load(d)
+        elif t == 'want_digest':
+            result = WantDigest.load(d)
+        elif t == 'digest':
+            result = Digest.load(d)
+        elif t == 'busy':
+            result = Busy.load(d)
 
         if result is not None:
             result.message = message
@@ -42,8 +58,8 @@ class SentenceFactory:
         return r
 
     @classmethod
-    def want_blocks_for_new_block(cls, new_block: NewBlock) -> Optional[WantBlocks]:
-        chain = Blockchain.load(new_block.chain_id)
+    async def want_blocks_for_new_block(cls, new_block: NewBlock) -> Optional[WantBlocks]:
+        chain = await StorageExecutor().run(Blockchain.load, new_block.chain_id)
         if chain is not None:
             if chain.height < new_block.height:
                 return cls.want_blocks(new_block.chain_id, chain.height, new_block.height - 1)
@@ -52,9 +68,18 @@ class SentenceFactory:
         return None
 
     @classmethod
-    def want_blocks_for_info(cls, info: Info) -> list:
+    async def want_blocks_for_info(cls, info: Info) -> list:
+        return await cls.want_blocks_for_chains(info.chains)
+
+    @classmethod
+    async def want_blocks_for_chains(cls, chains: dict) -> list:
+        # Chains are loaded in one storage call rather than one per chain
+        return await StorageExecutor().run(cls.__want_blocks_for_chains, chains)
+
+    @classmethod
+    def __want_blocks_for_chains(cls, chains: dict) -> list:
         result = []
-        for chain_id, height in info.chains.items():
+        for chain_id, height in chains.items():
             chain = Blockchain.load(chain_id)
             if chain is None:
                 if height > 0:
@@ -63,43 +88,100 @@ class SentenceFactory:
                 result.append(cls.want_blocks(chain_id, chain.height, height - 1))
         return result
 
+    @staticmethod
+    async def want_digest_for_info(info: Info) -> Optional[WantDigest]:
+        snapshot = await InfoSnapshot.shared()
+        if info.digest is not None and info.digest != snapshot.digest.root:
+            return WantDigest(prefixes=[''])
+        return None
+
+    @classmethod
+    async def want_for_digest(cls, digest: Digest) -> tuple:
+        """
+        Drill down into nodes differ from local digest
+
+        :param digest: answer of a WantDigest
+        :return: (WantDigest for different children or None, WantBlocks for chains behind)
+        """
+        nodes = {prefix: children for prefix, children in digest.nodes.items()
+                 if isinstance(prefix, str) and len(prefix) < ChainDigest.DEPTH
+                 and isinstance(children, list) and len(children) == len(ChainDigest.DIGITS)}
+        # Nothing to pull from children which remote has no chains in
+        snapshot = await InfoSnapshot.shared()
+        prefixes = [prefix for prefix in snapshot.differ(nodes)
+                    if nodes[prefix[:-1]][ChainDigest.DIGITS.index(prefix[-1])] != '%016x' % 0]
+        want_digest = WantDigest(prefixes=prefixes) if len(prefixes) > 0 else None
+        return want_digest, await cls.want_blocks_for_chains(digest.chains)
+
     @classmethod
     def want_peers_for_info(cls, info: Info) -> Optional[WantPeers]:
         if info.peers > 0:
             return WantPeers(count=info.peers)
         return None
 
-    @staticmethod
-    def send_blocks(want_blocks: WantBlocks):
-        chain = Blockchain.load(want_blocks.chain_id)
+    @classmethod
+    async def send_blocks(cls, want_blocks: WantBlocks, limit: int = int(2**20 * 1.5)):
+        """
+        Blocks sentences of the range, each one is yielded as soon as it is filled
+        so only one of them is held in memory at a time.
+
+        :param want_blocks: WantBlocks question
+        :param limit: max size of blocks in one sentence
+        :return: async generator of Blocks, the last one is marked as end
+        """
+        chain = await StorageExecutor().run(Blockchain.load, want_blocks.chain_id)
         if chain is None:
-            return None
+            # An empty answer rather than none, so the question is not taken as timed out
+            yield Blocks(raw=[], end=True)
+            return
 
-        blocks = chain.get_blocks(want_blocks.from_height, want_blocks.to_height)
-        if blocks is None:
-            return None
+        tip = chain.height - 1
+        key = (chain.id, want_blocks.from_height, min(want_blocks.to_height, tip), limit)
+        hot = cls.__hot_blocks.get(key)
+        if hot is not None:
+            cls.__hot_blocks.move_to_end(key)
+            yield hot[0]
+            return
 
-        # make every sentence size as large as possible but less than 1.5MB
-        answer = []
-        size = 0
-        tmp = []
-        for block in blocks:
-            if block.size + size > 2**20 * 1.5:
-                answer.append(Blocks(blocks=list(tmp), end=False))
-                tmp = [block]
-                size = 0
-            else:
-                size += block.size
-                tmp.append(block)
-        if len(tmp) > 0:
-            answer.append(Blocks(blocks=list(tmp), end=True))
-        answer[-1].end = True
-        return answer
+        # Encoded blocks are sliced into sentences without being decoded
+        batches = chain.iter_raw_blocks(want_blocks.from_height, want_blocks.to_height)
+        whole = True
+        try:
+            # make every sentence size as large as possible but less than the limit
+            size = 0
+            tmp = []
+            while True:
+                blocks = await StorageExecutor().run(next, batches, None)
+                if blocks is None:
+                    break
+                for data in blocks:
+                    if len(data) + size > limit and len(tmp) > 0:
+                        whole = False
+                        yield Blocks(raw=tmp, end=False)
+                        tmp = []
+                        size = 0
+                    size += len(data)
+                    tmp.append(data)
+            answer = Blocks(raw=tmp, end=True)
+            # Ranges are chosen by remote peers, only the fan-out of a new block is cached
+            if whole and len(tmp) > 0 and key[2] == tip and size <= cls.HOT_BLOCKS_SIZE:
+                cls.__cache_hot_blocks(key, answer, size)
+            yield answer
+        finally:
+            batches.close()
 
     @staticmethod
-    def send_peers(want_peers: WantPeers) -> Optional[Peers]:
+    async def send_digest(want_digest: WantDigest) -> Digest:
+        # A full level of leaves is the most one question can ask
+        prefixes = [prefix for prefix in want_digest.prefixes if len(prefix) <= ChainDigest.DEPTH]
+        snapshot = await InfoSnapshot.shared()
+        nodes, chains = snapshot.digest_of(prefixes[:len(ChainDigest.DIGITS) ** ChainDigest.DEPTH])
+        return Digest(nodes=nodes, chains=chains)
+
+    @staticmethod
+    async def send_peers(want_peers: WantPeers) -> Optional[Peers]:
         peers = []
-        for peer in PeerManager().peers(want_peers.count):
+        for peer in await StorageExecutor().run(PeerManager().peers, want_peers.count):
             peers.append(peer)
         if len(peers) <= 0:
             return None
@@ -116,19 +198,41 @@ class SentenceFactory:
         return response
 
     @staticmethod
-    def handle_peers(peers: Peers):
+    async def handle_peers(peers: Peers):
         if peers is None:
             return
 
         # TODO: need a better peers updating strategy
         for peer in peers.peers:
-            PeerManager().add_peer(peer)
+            await StorageExecutor().run(PeerManager().add_peer, peer)
 
-    @staticmethod
-    def handle_blocks(blocks: Blocks):
+    @classmethod
+    async def handle_blocks(cls, blocks: Blocks):
         if blocks is None:
             return
+        # Validation waits for the validation pool as well, it never runs in the event loop
+        await StorageExecutor().run(cls.__handle_blocks, blocks)
+
+    @classmethod
+    def __cache_hot_blocks(cls, key: tuple, answer: Blocks, size: int):
+        old = cls.__hot_blocks.pop(key, None)
+        if old is not None:
+            cls.__hot_size -= old[1]
+        cls.__hot_blocks[key] = (answer, size)
+        cls.__hot_size += size
+        while cls.__hot_size > cls.HOT_BLOCKS_CAPACITY:
+            _, (_, evicted) = cls.__hot_blocks.popitem(last=False)
+            cls.__hot_size -= evicted
+
+    @staticmethod
+    def __handle_blocks(blocks: Blocks):
 
         # TODO: need to mark bad chain (when there is two blocks which have same height)
+        segments = {}
         for block in blocks.blocks:
-            Blockchain.remote_chain(block.chain_id).save_block(block)
+            segments.setdefault(block.chain_id, []).append(block)
+
+        for chain_id, segment in segments.items():
+            saved = Blockchain.remote_chain(chain_id).save_blocks(segment)
+            if saved < len(segment):
+                log.info(f'{saved} of {len(segment)} blocks saved for {chain_id}')
@@ -0,0 +1,71 @@
+from time import monotonic
+from collections import deque
+
+
+class SeenCache:
+    """
+    Keys seen recently, memory is bounded by `capacity` keys and a key expires
+    after `ttl` seconds at most.
+
+    Keys are kept in a ring of generations, a new generation starts every
+    ttl / GENERATIONS seconds or when the current one is full, and the oldest
+    one is dropped as a whole.
+    """
+    GENERATIONS = 8
+
+    def __init__(self, ttl: float, capacity: int):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.__span = ttl / self.GENERATIONS
+        self.__size = max(1, capacity // self.GENERATIONS)
+        self.__generations = deque([set()], maxlen=self.GENERATIONS)
+        self.__started = monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def __rotate(self):
+        now = monotonic()
+        if now - self.__started >= self.ttl:
+            self.__generations = deque([set()], maxlen=self.GENERATIONS)
+            self.__started = now
+            return
+        while now - self.__started >= self.__span:
+            self.__generations.append(set())
+            self.__started += self.__span
+        if len(self.__generations[-1]) >= self.__size:
+            self.__generations.append(set())
+            self.__started = now
+
+    def __contains__(self, key) -> bool:
+        self.__rotate()
+        return any(key in generation for generation in self.__generations)
+
+    def __len__(self) -> int:
+        return sum(len(generation) for generation in self.__generations)
+
+    def add(self, key) -> bool:
+        """
+        :return: False if the key is seen already, counted as a hit
+        """
+        if key in self:
+            self.hits += 1
+            return False
+        self.misses += 1
+        self.__generations[-1].add(key)
+        return True
+
+    def remember(self, key):
+        """
+        Add a key without counting, for keys this node produces
+        """
+        if key not in self:
+            self.__generations[-1].add(key)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __repr__(self):
+        return '<SeenCache: %d keys, %d hits, %d misses (%.01f%% hit)>' % \
+               (len(self), self.hits, self.misses, self.hit_rate * 100)
@@ -1,10 +1,14 @@
 from platform import uname
 from enum import Enum
+from json import JSONEncoder, JSONDecoder
+from threading import Lock
 from dataclasses import dataclass, field
-from networking import Message
+from networking import Message, EncodedContent, codec
 from networking import Peer, PeerManager
-from blockchain import Block, Blockchain
+from blockchain import Block, Blockchain, Database
 from utils.reprutil import flat_dict_for_repr
+from utils import Singleton, StorageExecutor
+from .digest import ChainDigest
 
 
 @dataclass
@@ -18,6 +22,9 @@ class Sentence:
         WANT_BLOCKS = 'want_blocks'
         BLOCKS = 'blocks'
         NEW_BLOCK = 'new_block'
+        WANT_DIGEST = 'want_digest'
+        DIGEST = 'digest'
+        BUSY = 'busy'
 
     message: Message = None
     type: Type = Type.EMPTY
@@ -32,70 +39,212 @@ class Sentence:
             'type': self.type.value
         }
 
+    @property
+    def content(self):
+        """
+        :return: content of message, a dict or EncodedContent
+        """
+        return self.dict
+
     @property
     def question(self):
-        return Message(self.dict)
+        return Message(self.content, content_type=self.type.value)
 
     def to(self, question):
-        return Message(self.dict,
-                       Message.Type.ERROR if self.type == Sentence.Type.ERROR else Message.Type.ANSWER,
-                       question.message.identifier)
+        return Message(self.content,
+                       Message.Type.ERROR if self.type in (Sentence.Type.ERROR, Sentence.Type.BUSY)
+                       else Message.Type.ANSWER,
+                       question.message.identifier,
+                       self.type.value)
 
     def __repr__(self):
         return (f'{self.message}\n' if self.message is not None else '') + flat_dict_for_repr(self.dict)
 
 
+class InfoSnapshot(metaclass=Singleton):
+    """
+    Information of this node, chain heights and digest are updated when tips move
+    so building an Info never walks through all chains.
+    """
+
+    def __init__(self):
+        info = uname()
+        self.platform = {
+            'system': info.system,
+            'version': info.release,
+            'node': info.node
+        }
+        self.__lock = Lock()
+        # version -> encoded content
+        self.__encoded = {}
+        self.__peers = PeerManager().count
+        self.chains = {chain.id: chain.height for chain in Blockchain.all_chains()}
+        # Empty chains have nothing to download, nodes differ only in them would never converge
+        self.digest = ChainDigest({chain_id: height for chain_id, height in self.chains.items() if height > 0})
+        Database().add_tip_listener(self.__tip_moved)
+
+    @classmethod
+    async def shared(cls) -> 'InfoSnapshot':
+        """
+        :return: the snapshot, it is built in storage executor at the first time
+        """
+        snapshot = Singleton.instances.get(cls)
+        if snapshot is None:
+            snapshot = await StorageExecutor().run(cls)
+        return snapshot
+
+    def __tip_moved(self, chain_id, height, _):
+        with self.__lock:
+            self.chains[chain_id] = height
+            if height > 0:
+                self.digest.update(chain_id, height)
+            self.__encoded = {}
+
+    @property
+    def peers(self) -> int:
+        count = PeerManager().count
+        if count != self.__peers:
+            with self.__lock:
+                self.__peers = count
+                self.__encoded = {}
+        return count
+
+    def encoded(self, version: str, build) -> EncodedContent:
+        """
+        :param version: version of Info
+        :param build: function gives content dict with count of peers and digest root
+        :return: content encoded once after each change
+        """
+        peers = self.peers
+        with self.__lock:
+            encoded = self.__encoded.get(version)
+            if encoded is None:
+                encoded = EncodedContent(JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+                                         .encode(build(peers, self.digest.root)).encode('utf8'))
+                self.__encoded[version] = encoded
+            return encoded
+
+    def digest_of(self, prefixes: list) -> tuple:
+        """
+        :param prefixes: prefixes of digest nodes
+        :return: ({prefix: children values} for inner nodes, {chain_id: height} in leaf buckets)
+        """
+        nodes = {}
+        chains = {}
+        with self.__lock:
+            for prefix in prefixes:
+                if len(prefix) < ChainDigest.DEPTH:
+                    nodes[prefix] = self.digest.children(prefix)
+                else:
+                    chains.update(self.digest.chains(prefix))
+        return nodes, chains
+
+    def differ(self, nodes: dict) -> list:
+        with self.__lock:
+            return [child for prefix, children in nodes.items() for child in self.digest.differ(prefix, children)]
+
+
 @dataclass
 class Info(Sentence):
+    # Nodes since 0.2 exchange a digest of chains instead of all chain heights
+    LEGACY_VERSION = '0.1'
+    VERSION = '0.2'
 
     type: Sentence.Type = Sentence.Type.INFO
 
-    version: str = '0.1'
+    version: str = VERSION
     peers: int = 0
     chains: dict = field(default_factory=dict)
     platform: dict = field(default_factory=dict)
     is_full_node: bool = True
+    digest: str = None
+    # Wire formats the node can load, JSON only for nodes before binary frames
+    formats: list = field(default_factory=lambda: ['json'])
+    # Compression methods the node can load
+    compression: list = field(default_factory=list)
+    is_local: bool = True
 
     def __post_init__(self):
-        info = uname()
-        self.platform = {
-            'system': info.system,
-            'version': info.release,
-            'node': info.node
-        }
-
-        chains = Blockchain.all_chains()
-        for chain in chains:
-            self.chains[chain.id] = chain.height
+        if not self.is_local:
+            return
+        # Info of this node refers to the snapshot, nothing is copied
+        snapshot = InfoSnapshot()
+        self.platform = snapshot.platform
+        self.peers = snapshot.peers
+        self.formats = list(Message.FORMATS)
+        self.compression = ['zlib']
+        if self.supports_digest:
+            self.digest = snapshot.digest.root
+        else:
+            self.chains = snapshot.chains
 
-        self.peers = PeerManager().count
+    @classmethod
+    async def local(cls, version: str = VERSION) -> 'Info':
+        """
+        Info of this node, without blocking the event loop when the snapshot is not built yet
+        """
+        await InfoSnapshot.shared()
+        return cls(version=version)
 
     @classmethod
     def load(cls, d):
-        info = cls()
+        info = cls(is_local=False)
         try:
             info.version = d['version']
             info.peers = d['peers']
             info.chains = d['chains']
             info.platform = d['platform']
             info.is_full_node = d['full_node']
+            info.digest = d.get('digest')
+            formats = d.get('formats')
+            if isinstance(formats, list):
+                info.formats = formats
+            compression = d.get('compression')
+            if isinstance(compression, list):
+                info.compression = compression
             return info
         except (KeyError, ValueError):
             return None
 
+    @property
+    def supports_digest(self) -> bool:
+        try:
+            return tuple(int(n) for n in self.version.split('.')) >= (0, 2)
+        except (AttributeError, ValueError):
+            return False
+
     @property
     def dict(self):
-        return {
+        result = {
             **super().dict,
             'version': self.version,
             'peers': self.peers,
             'chains': self.chains,
             'platform': self.platform,
-            'full_node': self.is_full_node
+            'full_node': self.is_full_node,
+            'formats': self.formats,
+            'compression': self.compression
         }
+        if self.digest is not None:
+            result['digest'] = self.digest
+        return result
+
+    @property
+    def content(self):
+        if not self.is_local:
+            return self.dict
+
+        def build(peers, root):
+            result = {**self.dict, 'peers': peers}
+            if self.supports_digest:
+                result['digest'] = root
+            return result
+        return InfoSnapshot().encoded(self.version, build)
 
     def __repr__(self):
-        return super().__repr__()
+        # Chains may be thousands, only count them
+        return (f'{self.message}\n' if self.message is not None else '') + \
+            flat_dict_for_repr({**self.dict, 'chains': f'{len(self.chains)} chains'})
 
 
 @dataclass
@@ -222,6 +371,9 @@ class Blocks(Sentence):
 
     blocks: list = field(default_factory=list)
     end: bool = True
+    # Canonical encoded blocks to send without decoding, used instead of `blocks`
+    raw: list = None
+    encoded: EncodedContent = None
 
     @classmethod
     def load(cls, d):
@@ -242,8 +394,38 @@ class Blocks(Sentence):
             'end': self.end
         }
 
+    @property
+    def content(self):
+        if self.raw is None:
+            return self.dict
+        # Built once, a hot chunk answered to many peers is not encoded again
+        if self.encoded is None:
+            self.encoded = EncodedContent(self.__json, self.__binary)
+        return self.encoded
+
+    def __json(self) -> bytes:
+        return b''.join([
+            b'{"type":"', self.type.value.encode('utf8'), b'","end":', b'true' if self.end else b'false',
+            b',"blocks":[', b','.join(self.raw), b']}'
+        ])
+
+    def __binary(self) -> bytes:
+        # Blocks are encoded one by one into the frame, the joined JSON is not built for it
+        return codec.dump_value({
+            'type': self.type.value,
+            'end': self.end,
+            'blocks': [codec.Encoded(codec.dump_value(JSONDecoder().decode(bytes(data).decode('utf8'))))
+                       for data in self.raw]
+        })
+
     def __repr__(self):
-        return super().__repr__()
+        if self.raw is None:
+            return super().__repr__()
+        return (f'{self.message}\n' if self.message is not None else '') + flat_dict_for_repr({
+            'type': self.type.value,
+            'blocks': f'{len(self.raw)} encoded blocks ({sum(len(data) for data in self.raw)} bytes)',
+            'end': self.end
+        })
 
 
 @dataclass
@@ -282,11 +464,104 @@ class NewBlock(Sentence):
         return super().__repr__()
 
 
+@dataclass
+class WantDigest(Sentence):
+
+    type: Sentence.Type = Sentence.Type.WANT_DIGEST
+
+    prefixes: list = field(default_factory=list)
+
+    @classmethod
+    def load(cls, d):
+        want_digest = cls()
+        try:
+            want_digest.prefixes = [str(prefix) for prefix in d['prefixes']]
+            return want_digest
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    @property
+    def dict(self):
+        return {
+            **super().dict,
+            'prefixes': self.prefixes
+        }
+
+    def __repr__(self):
+        return super().__repr__()
+
+
+@dataclass
+class Digest(Sentence):
+
+    type: Sentence.Type = Sentence.Type.DIGEST
+
+    # prefix -> values of children for inner nodes
+    nodes: dict = field(default_factory=dict)
+    # chain_id -> height in asked leaf buckets
+    chains: dict = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, d):
+        digest = cls()
+        try:
+            digest.nodes = d['nodes']
+            digest.chains = d['chains']
+            return digest
+        except (KeyError, ValueError):
+            return None
+
+    @property
+    def dict(self):
+        return {
+            **super().dict,
+            'nodes': self.nodes,
+            'chains': self.chains
+        }
+
+    def __repr__(self):
+        return super().__repr__()
+
+
 # TODO: Broadcast or answer BadChain when received a valid block which height is already exist
 class BadChain(Sentence):
     pass
 
 
-# TODO: Send a Busy to client when too many connections alive
+@dataclass
 class Busy(Sentence):
-    pass
+    """
+    Sent instead of an answer when this node is not able to serve the peer now,
+    or to a peer turned away when too many peers are connected.
+    """
+
+    type: Sentence.Type = Sentence.Type.BUSY
+
+    # Seconds to wait before asking again
+    retry_after: float = 0
+    desc: str = ''
+
+    @classmethod
+    def load(cls, d):
+        busy = cls()
+        try:
+            busy.retry_after = float(d['retry_after'])
+            busy.desc = d['desc']
+            return busy
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    @property
+    def notice(self):
+        return Message(self.content, Message.Type.ERROR, content_type=self.type.value)
+
+    @property
+    def dict(self):
+        return {
+            **super().dict,
+            'retry_after': self.retry_after,
+            'desc': self.desc
+        }
+
+    def __repr__(self):
+        return super().__repr__()
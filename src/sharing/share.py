@@ -1,27 +1,82 @@
-from threading import Thread, Timer
-from networking import Peer, Message, Server, PeerManager
-from .sentence import Sentence, Info
+import asyncio
+
+from threading import Thread
+from collections import OrderedDict
+from concurrent.futures import Future
+from networking import Peer, Message, Frame, Server, PeerManager
+from networking.limit import PeerLimits
+from .sentence import Sentence, Info, Busy
 from .factory import SentenceFactory as Factory
+from .seen import SeenCache
+from .sync import SyncScheduler
 
-from utils import settings, Singleton, log
+from utils import settings, Singleton, log, StorageExecutor
 
 
 class ShareManager(metaclass=Singleton):
+    """
+    Every peer and the server run as tasks on one event loop owned by this manager,
+    other threads hand work to it with `submit`.
+    """
+
     def __init__(self):
         self.servers = [peer for peer in PeerManager().peers(without_self=True) if peer.address]
         self.clients = []
-        self.broadcast_cache = {}
+        # Broadcast identifiers and announced (chain_id, height) seen recently
+        self.seen = SeenCache(settings.broadcast.ttl, settings.broadcast.capacity)
+        # address -> PeerLimits, kept while a peer is limited even after it disconnected,
+        # in order of last use
+        self.limits = OrderedDict()
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        # The loop keeps only weak references of tasks
+        self.__tasks = set()
+        self.syncing = SyncScheduler(self.spawn)
 
     def start(self):
+        Thread(target=self.__run, name='p2p').start()
+        self.submit(self.__start())
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def __start(self):
         for peer in self.servers:
             peer.peer_in = self.peer_in
             peer.peer_out = self.peer_out
-            Thread(target=peer.open).start()
+            self.connect(peer)
 
         server = Server()
         server.peer_in = self.peer_in
         server.peer_out = self.peer_out
-        Thread(target=server.start).start()
+        server.admit = self.admit
+        self.server = await server.start()
+
+    def submit(self, coroutine) -> Future:
+        """
+        Run a coroutine on the event loop of peers, it is safe to be called from any thread
+
+        :param coroutine: coroutine object
+        :return: concurrent.futures.Future of the result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    def connect(self, peer):
+        self.spawn(peer.open())
+
+    async def connected_peers(self) -> list:
+        """
+        :return: connected peers, faster and more stable ones first
+        """
+        peers = [peer for peer in self.servers + self.clients if peer.is_connected]
+        return sorted(peers, key=lambda peer: peer.score, reverse=True)
 
     def refresh(self):
         # TODO: need a connection strategy (when current connections is less then specific number)
@@ -32,33 +87,82 @@ class ShareManager(metaclass=Singleton):
             self.servers.remove(peer)
             self.refresh()
         elif peer not in self.clients:
-            secs = (peer.retry_count + 1) ** 4
+            secs = max((peer.retry_count + 1) ** 4, peer.retry_after)
+            peer.retry_after = 0
             log.warning(f'Retry after {secs} secs.')
-            Timer(secs, peer.open).start()
+            self.loop.call_later(secs, self.connect, peer)
+
+    # Seconds a peer turned away should wait before connecting again
+    ADMISSION_RETRY = 60
+    # Longest delay to throttle blocks served to a peer, asking more gets Busy
+    SERVING_DELAY = 5
+    # Seconds to wait when too many ranges are being served to a peer
+    SERVING_RETRY = 1
+
+    # Limits kept for addresses in multiples of inbound peers, the least recently used are evicted over it
+    LIMITS_PER_INBOUND = 4
+
+    def limits_of(self, peer) -> PeerLimits:
+        limits = self.limits.get(peer.address)
+        if limits is not None:
+            self.limits.move_to_end(peer.address)
+            return limits
+        if len(self.limits) >= settings.limits.inbound:
+            # Limits fully refilled expire
+            self.limits = OrderedDict((address, limits) for address, limits in self.limits.items()
+                                      if not limits.is_idle)
+        # Addresses which are still limited can not grow the map without bound
+        while len(self.limits) >= settings.limits.inbound * self.LIMITS_PER_INBOUND:
+            self.limits.popitem(last=False)
+        limits = PeerLimits()
+        self.limits[peer.address] = limits
+        return limits
+
+    async def admit(self, peer) -> bool:
+        if len(self.clients) < settings.limits.inbound:
+            return True
+        log.warning(f'Turn away {peer}: {len(self.clients)} peers connected')
+        busy = Busy(retry_after=self.ADMISSION_RETRY, desc='Too many peers connected')
+        await peer.send(busy.notice)
+        return False
 
     async def peer_in(self, peer):
         log.info(f'Peer in : {peer}')
         peer.dispatcher.global_handler = self.handle
+        peer.version = None
         if peer.is_server:
-            await peer.send(Info().question)
+            # Digest only, heights are sent after the answer shows the peer is a legacy node
+            info = await Info.local()
+            await peer.send(info.question)
         else:
             self.clients.append(peer)
 
     async def peer_out(self, peer):
+        self.syncing.forget(peer)
         if peer.is_server:
             log.warning(f'Peer out: {peer}')
+            peer.update_rank()
             peer.rank -= 1
             peer.retry_count += 1
-            peer.save()
+            await StorageExecutor().run(peer.save)
             self.retry(peer)
         else:
             log.info(f'Peer out: {peer}')
             self.clients.remove(peer)
 
     async def handle(self, message: Message, peer: Peer):
+        """
+        :return: the sentence handled
+        """
+        if message.type == Message.Type.ANSWER and message.identifier in self.syncing.finished:
+            # Rest of a window answered by another peer or timed out
+            return None
+
         sentence = Factory.load(message)
         if sentence is None:
             log.warning(f'Bad sentence:\n{message.content}')
+            peer.stats.error()
+            return None
 
         log.debug(f'{peer} said:\n{sentence}')
         if message.type == Message.Type.QUESTION:
@@ -67,55 +171,115 @@ class ShareManager(metaclass=Singleton):
             await self.handle_anwser(sentence, peer)
         elif message.type == Message.Type.BROADCAST:
             await self.handle_broadcast(sentence, peer)
+        elif message.type == Message.Type.ERROR:
+            await self.handle_error(sentence, peer)
+        return sentence
 
     async def handle_question(self, question, peer: Peer):
+        limits = self.limits_of(peer)
+        wait = limits.questions.take()
+        if wait > 0:
+            await self.send_answer(Busy(retry_after=wait, desc='Too many questions'), question, peer)
+            return
+
         answer = None
         if question.type == Sentence.Type.INFO:
-            answer = Info()
+            answer = await Info.local(Info.VERSION if question.supports_digest else Info.LEGACY_VERSION)
             await self.info_actions(question, peer)
         elif question.type == Sentence.Type.WANT_BLOCKS:
-            answer = Factory.send_blocks(question)
-            for block in answer:
-                await self.send_answer(block, question, peer)
-            return
+            if limits.served.delay > self.SERVING_DELAY:
+                answer = Busy(retry_after=limits.served.delay, desc='Too many blocks asked')
+            elif limits.serving >= settings.limits.serving:
+                answer = Busy(retry_after=self.SERVING_RETRY, desc='Too many ranges asked at once')
+            else:
+                # Served by a task, so answers this peer sends meanwhile are still read
+                limits.serving += 1
+                self.spawn(self.serve_blocks(question, peer, limits))
         elif question.type == Sentence.Type.WANT_PEERS:
-            answer = Factory.send_peers(question)
+            answer = await Factory.send_peers(question)
+        elif question.type == Sentence.Type.WANT_DIGEST:
+            answer = await Factory.send_digest(question)
 
         if answer is not None:
             await self.send_answer(answer, question, peer)
 
+    async def serve_blocks(self, want_blocks, peer: Peer, limits: PeerLimits):
+        try:
+            # Sending waits while the socket's write buffer is full
+            async for blocks in Factory.send_blocks(want_blocks, peer.content_limit):
+                if not peer.is_connected:
+                    break
+                # Throttled by bytes served to the peer
+                wait = limits.served.consume(sum(len(data) for data in blocks.raw))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self.send_answer(blocks, want_blocks, peer)
+        finally:
+            limits.serving -= 1
+
     async def handle_anwser(self, answer, peer: Peer):
         if answer.type == Sentence.Type.INFO:
+            first = peer.version is None
             await self.info_actions(answer, peer)
+            if first and not answer.supports_digest:
+                # A node before digest learns chains of this node only from heights in an Info question
+                info = await Info.local(Info.LEGACY_VERSION)
+                await self.send_question(info, peer)
         elif answer.type == Sentence.Type.BLOCKS:
-            Factory.handle_blocks(answer)
+            await Factory.handle_blocks(answer)
         elif answer.type == Sentence.Type.PEERS:
-            Factory.handle_peers(answer)
+            await Factory.handle_peers(answer)
+        elif answer.type == Sentence.Type.DIGEST:
+            await self.digest_actions(answer, peer)
+
+    @staticmethod
+    async def handle_error(sentence, peer: Peer):
+        if sentence.type == Sentence.Type.BUSY:
+            log.info(f'{peer} is busy, retry after {sentence.retry_after:.01f} secs: {sentence.desc}')
+            peer.retry_after = sentence.retry_after
 
     async def handle_broadcast(self, sentence, peer):
-        last = self.broadcast_cache.get(sentence.message.identifier)
-        if sentence.type == Sentence.Type.NEW_BLOCK and last is None:
-            self.broadcast_cache[sentence.message.identifier] = sentence
-
-            wb = Factory.want_blocks_for_new_block(sentence)
-            if wb is not None:
-                async def handle_blocks(msg, p):
-                    await self.handle(msg, p)
-                    sen = Factory.load(msg)
-                    if sen.type == Sentence.Type.BLOCKS and sen.end:
-                        await self.broadcast(sentence, peer)
-                        return True
-                await self.send_question(wb, peer, handle_blocks)
+        if sentence.type != Sentence.Type.NEW_BLOCK:
+            return
+        # The same block announced under another identifier is not asked again
+        if not self.seen.add(('id', sentence.message.identifier)) \
+                or not self.seen.add(('block', sentence.chain_id, sentence.height)):
+            return
+
+        wb = await Factory.want_blocks_for_new_block(sentence)
+        if wb is not None:
+            # Waiting for a free question slot here would block reading the answers freeing it
+            self.spawn(self.want_new_block(sentence, wb, peer))
+
+    async def want_new_block(self, sentence, want_blocks, peer: Peer):
+        """
+        Ask blocks of an announced block and broadcast it when they are saved,
+        asked again after the time a busy peer told
+        """
+        async def handle_blocks(msg, p):
+            sen = await self.handle(msg, p)
+            if sen is not None and sen.type == Sentence.Type.BUSY:
+                self.loop.call_later(sen.retry_after, self.spawn, self.want_new_block(sentence, want_blocks, p))
+                return True
+            if sen is not None and sen.type == Sentence.Type.BLOCKS and sen.end:
+                await self.broadcast(sentence, peer)
+                return True
+        await self.send_question(want_blocks, peer, handle_blocks)
 
     async def broadcast(self, sentence, without=None):
-        self.broadcast_cache[sentence.boardcast.identifier] = sentence
+        # Encoded once for each wire format, the same buffer goes to every peer
+        frame = Frame(sentence.boardcast)
+        self.seen.remember(('id', frame.identifier))
+        if sentence.type == Sentence.Type.NEW_BLOCK:
+            self.seen.remember(('block', sentence.chain_id, sentence.height))
 
         log.debug(f'Broadcasting:\n{sentence}')
-        for peer in self.servers + self.clients:
+        # Queued to every peer at once, a slow peer does not hold back others
+        for peer in await self.connected_peers():
             if without is not None and peer.address == without.address and peer.port == without.port:
                 continue
-            await peer.send(sentence.boardcast)
-            log.debug(f'Broadcast sent to {peer}')
+            if peer.post(frame):
+                log.debug(f'Broadcast queued to {peer}')
 
     async def info_actions(self, info: Info, peer: Peer):
         if isinstance(info, Message):
@@ -123,18 +287,40 @@ class ShareManager(metaclass=Singleton):
         if info is None:
             return
 
-        for want_blocks in Factory.want_blocks_for_info(info):
-            await self.send_question(want_blocks, peer)
+        peer.version = info.version
+        # Messages after Info use binary frames if the peer announced it can load them
+        peer.binary = 'binary' in info.formats
+        peer.compression = 'zlib' in info.compression
+
+        if info.digest is not None:
+            want_digest = await Factory.want_digest_for_info(info)
+            if want_digest is not None:
+                await self.send_question(want_digest, peer)
+        else:
+            await self.sync(await Factory.want_blocks_for_info(info), peer)
 
         if settings.peers.sync:
             want_peers = Factory.want_peers_for_info(info)
             if want_peers is not None:
                 await self.send_question(want_peers, peer)
 
+    async def digest_actions(self, digest, peer: Peer):
+        want_digest, want_blocks_list = await Factory.want_for_digest(digest)
+        await self.sync(want_blocks_list, peer)
+        if want_digest is not None:
+            await self.send_question(want_digest, peer)
+
+    async def sync(self, want_blocks_list: list, peer: Peer):
+        """
+        Blocks advertised by a peer are downloaded in windows from every peer advertising them
+        """
+        for want_blocks in want_blocks_list:
+            self.syncing.want(want_blocks, peer)
+
     @staticmethod
     async def send_question(question: Sentence, to: Peer, callback=None):
         log.debug(f'Ask to {to}:\n{question}')
-        await to.send(question.question, callback)
+        return await to.send(question.question, callback)
 
     @staticmethod
     async def send_answer(answer: Sentence, question: Sentence, to: Peer):
@@ -0,0 +1,367 @@
+import asyncio
+
+from typing import Optional
+from websockets.exceptions import ConnectionClosed
+from networking import Peer
+from blockchain import Blockchain
+from .sentence import Sentence, WantBlocks
+from .factory import SentenceFactory as Factory
+from .seen import SeenCache
+
+from utils import settings, log, StorageExecutor
+
+
+class Window:
+    """
+    A range of heights [start, end] asked from one peer at a time,
+    a stalled window is asked from one more peer and the first answer wins.
+    """
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        # Validated blocks waiting to be saved in height order
+        self.blocks = None
+        self.source = None
+        # peer -> (Pending or None while waiting for a free slot, time asked)
+        self.fetching = {}
+        # Peers failed or ran short of this window
+        self.tried = set()
+        self.rounds = 0
+        # Blocks received are being validated
+        self.checking = False
+        # Bytes of blocks kept until they are saved
+        self.size = 0
+
+    @property
+    def is_done(self) -> bool:
+        return self.blocks is not None
+
+    def __repr__(self):
+        return f'<Window: [{self.start}, {self.end}], {len(self.fetching)} fetching, done: {self.is_done}>'
+
+
+class ChainSync:
+    """
+    Download state of one chain, windows are kept in height order.
+    """
+
+    def __init__(self, chain_id: str, height: int):
+        self.chain_id = chain_id
+        # Local height, blocks below it are saved
+        self.height = height
+        # Height advertised by peers, blocks below it are wanted
+        self.target = height
+        # Next height not covered by a window yet
+        self.next = height
+        self.windows = []
+        # peer -> height it advertised
+        self.sources = {}
+        # peer -> loop time until which it is busy
+        self.resting = {}
+        self.lock = asyncio.Lock()
+
+    def __repr__(self):
+        return f'<ChainSync: {self.chain_id} {self.height}/{self.target}, ' \
+               f'{len(self.windows)} windows, {len(self.sources)} sources>'
+
+
+class SyncScheduler:
+    """
+    Download missing blocks of chains from every peer advertising them.
+
+    A missing range is split into windows of `settings.sync.window` blocks, windows
+    are asked from the best scoring peers with at most `settings.sync.per_peer` from
+    each peer over all chains, and at most `settings.sync.windows` windows are in flight or buffered
+    for a chain. Blocks received and not saved yet are bounded by `settings.sync.buffer` bytes over
+    all chains, only the lowest window of a chain is asked beyond it. Blocks are validated as soon as a window arrives, but saved only in
+    height order. A window failed, ran short or answered with Busy goes to another
+    peer, and the window holding back saving is also asked from another peer once it
+    stalls for `settings.sync.stall` seconds.
+    """
+
+    # Rounds over all advertising peers before giving up a window
+    ROUNDS = 3
+    # Questions finished early remembered to drop their late answers
+    FINISHED_CAPACITY = 4096
+    # Largest block, payload is less than 1MB
+    MAX_BLOCK_SIZE = 2**20 + 4096
+
+    def __init__(self, spawn):
+        """
+        :param spawn: function to run a coroutine as a task on the loop of peers
+        """
+        self.spawn = spawn
+        self.chains = {}
+        # peer -> count of windows being fetched from it, of every chain
+        self.loads = {}
+        # Identifiers of questions finished, answers still arriving are not handled again
+        self.finished = SeenCache(settings.peers.timeout * 2, self.FINISHED_CAPACITY)
+        # Bytes of blocks being received or waiting to be saved, of every chain
+        self.buffered = 0
+
+    def want(self, want_blocks: WantBlocks, peer: Peer):
+        """
+        :param want_blocks: blocks missing locally which the peer has
+        :param peer: peer advertised the blocks
+        """
+        sync = self.chains.get(want_blocks.chain_id)
+        if sync is None:
+            sync = ChainSync(want_blocks.chain_id, want_blocks.from_height)
+            self.chains[sync.chain_id] = sync
+        height = want_blocks.to_height + 1
+        sync.sources[peer] = max(sync.sources.get(peer, 0), height)
+        sync.target = max(sync.target, height)
+        self.schedule(sync)
+
+    def forget(self, peer: Peer):
+        """
+        Drop a disconnected peer, windows it was fetching are finished by its dispatcher
+        """
+        for sync in self.chains.values():
+            sync.sources.pop(peer, None)
+            sync.resting.pop(peer, None)
+            for window in sync.windows:
+                window.tried.discard(peer)
+
+    def schedule_all(self):
+        for sync in list(self.chains.values()):
+            self.schedule(sync)
+
+    def schedule(self, sync: ChainSync):
+        if self.chains.get(sync.chain_id) is not sync:
+            return
+        while sync.next < sync.target and len(sync.windows) < settings.sync.windows:
+            end = min(sync.next + settings.sync.window, sync.target) - 1
+            sync.windows.append(Window(sync.next, end))
+            sync.next = end + 1
+
+        now = asyncio.get_event_loop().time()
+        for window in sync.windows:
+            if window.is_done or window.checking:
+                continue
+            stalled = len(window.fetching) == 1 and window is self.__head(sync) \
+                and all(now - asked > settings.sync.stall for _, asked in window.fetching.values())
+            if len(window.fetching) > 0 and not stalled:
+                continue
+            if self.buffered >= settings.sync.buffer and window is not self.__head(sync):
+                break
+            peer = self.__choose(sync, window, now)
+            if peer is None:
+                if len(window.fetching) == 0 and not self.__retry(sync, window):
+                    return
+                continue
+            window.fetching[peer] = (None, now)
+            self.loads[peer] = self.loads.get(peer, 0) + 1
+            self.spawn(self.__fetch(sync, window, peer))
+
+        if sync.height >= sync.target and len(sync.windows) == 0:
+            log.info(f'{sync.chain_id} synced to height {sync.height}')
+            del self.chains[sync.chain_id]
+
+    def __drop(self, sync: ChainSync):
+        del self.chains[sync.chain_id]
+        for window in sync.windows:
+            self.__release(window)
+
+    def __release(self, window: Window):
+        self.buffered -= window.size
+        window.size = 0
+
+    @staticmethod
+    def __head(sync: ChainSync):
+        return next((window for window in sync.windows if not window.is_done), None)
+
+    def __choose(self, sync: ChainSync, window: Window, now: float):
+        candidates = [
+            peer for peer, height in sync.sources.items()
+            if peer.is_connected and height > window.start and peer not in window.tried
+            and peer not in window.fetching and sync.resting.get(peer, 0) <= now
+            and self.loads.get(peer, 0) < settings.sync.per_peer
+        ]
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda peer: peer.score)
+
+    def __retry(self, sync: ChainSync, window: Window) -> bool:
+        """
+        Start another round over peers which were tried for a window nobody is fetching
+
+        :return: False if the chain is given up
+        """
+        waiting = [peer for peer, height in sync.sources.items()
+                   if peer.is_connected and height > window.start and peer not in window.tried]
+        if len(waiting) > 0:
+            # Untried peers are busy or resting, the window waits for them
+            return True
+        if len(window.tried) == 0:
+            log.info(f'No peer left to sync {sync}')
+            self.__drop(sync)
+            return False
+        window.rounds += 1
+        if window.rounds >= self.ROUNDS:
+            log.warning(f'Give up syncing {sync.chain_id} at {window}')
+            self.__drop(sync)
+            return False
+        window.tried.clear()
+        asyncio.get_event_loop().call_later(settings.sync.stall, self.schedule, sync)
+        return True
+
+    async def __fetch(self, sync: ChainSync, window: Window, peer: Peer):
+        blocks = []
+        try:
+            try:
+                answer = await self.__download(sync, window, peer, blocks)
+            finally:
+                window.fetching.pop(peer, None)
+                self.loads[peer] -= 1
+                if self.loads[peer] == 0:
+                    del self.loads[peer]
+
+            if not window.is_done and window in sync.windows:
+                if answer is not None and len(blocks) > 0:
+                    window.checking = True
+                    try:
+                        await self.__accept(sync, window, blocks, peer, answer)
+                    finally:
+                        window.checking = False
+                else:
+                    window.tried.add(peer)
+        finally:
+            # Blocks accepted are counted in their window
+            self.buffered -= sum(block.size for block in blocks)
+        # The peer is free for windows of any chain
+        self.schedule_all()
+
+    async def __download(self, sync: ChainSync, window: Window, peer: Peer, blocks: list) -> Optional[bool]:
+        """
+        :param blocks: blocks received are appended to it, in the window only
+        :return: None if the window is not answered, True if it is answered to the end,
+                 False if it is cut by `settings.sync.window_bytes`
+        """
+        want_blocks = WantBlocks(chain_id=sync.chain_id, from_height=window.start, to_height=window.end)
+        try:
+            pending = await peer.request(want_blocks.question, multiple=True)
+        except ConnectionClosed:
+            pending = None
+        if pending is None:
+            return None
+        if window.is_done or peer not in window.fetching:
+            # Answered by another peer while waiting for a free question slot
+            pending.finish()
+            self.finished.remember(pending.identifier)
+            return None
+
+        window.fetching[peer] = (pending, window.fetching[peer][1])
+        loop = asyncio.get_event_loop()
+        loop.call_later(settings.sync.stall, self.schedule, sync)
+        count = window.end - window.start + 1
+        size = 0
+        try:
+            async for message in pending:
+                sentence = Factory.load(message)
+                if sentence is None:
+                    peer.stats.error()
+                    return None
+                if sentence.type == Sentence.Type.BUSY:
+                    sync.resting[peer] = loop.time() + sentence.retry_after
+                    loop.call_later(sentence.retry_after, self.schedule, sync)
+                    return None
+                if sentence.type != Sentence.Type.BLOCKS:
+                    return None
+                for block in sentence.blocks:
+                    # Blocks out of the window or more than it holds are never sent by a sound peer
+                    if block.chain_id != sync.chain_id or not window.start <= block.height <= window.end \
+                            or len(blocks) >= count:
+                        log.info(f'{peer} answered {window} of {sync.chain_id} with a block out of it')
+                        peer.stats.error()
+                        return None
+                    blocks.append(block)
+                    size += block.size
+                    self.buffered += block.size
+                if size > count * self.MAX_BLOCK_SIZE:
+                    peer.stats.error()
+                    return None
+                if sentence.end or len(blocks) == count:
+                    return True
+                if size >= settings.sync.window_bytes:
+                    # The rest of the window is asked again as a new window
+                    return False
+        finally:
+            pending.finish()
+            self.finished.remember(pending.identifier)
+        return None
+
+    async def __accept(self, sync: ChainSync, window: Window, blocks: list, peer: Peer, whole: bool):
+        """
+        Keep the valid run of blocks from the start of a window, the rest becomes a new window
+
+        :param whole: the peer answered to the end, otherwise the answer is cut by this node
+        """
+        blocks = sorted(blocks, key=lambda block: block.height)
+        results = await StorageExecutor().run(Blockchain.validate_blocks, blocks)
+        accepted = []
+        for block, valid in zip(blocks, results):
+            if not valid or block.height != window.start + len(accepted):
+                break
+            accepted.append(block)
+
+        if window.is_done or window not in sync.windows:
+            return
+        window.tried.add(peer)
+        if len(accepted) == 0:
+            log.info(f'No valid block of {window} from {peer}')
+            peer.stats.error()
+            return
+
+        for pending, _ in list(window.fetching.values()):
+            if pending is not None:
+                pending.finish()
+        if accepted[-1].height < window.end:
+            rest = Window(accepted[-1].height + 1, window.end)
+            if whole:
+                rest.tried.add(peer)
+            sync.windows.insert(sync.windows.index(window) + 1, rest)
+            window.end = accepted[-1].height
+        window.blocks = accepted
+        window.source = peer
+        window.size = sum(block.size for block in accepted)
+        self.buffered += window.size
+        await self.__apply(sync)
+
+    async def __apply(self, sync: ChainSync):
+        async with sync.lock:
+            while len(sync.windows) > 0 and sync.windows[0].is_done:
+                window = sync.windows.pop(0)
+                if window.end < sync.height:
+                    self.__release(window)
+                    continue
+                try:
+                    height = await StorageExecutor().run(self.__save, sync.chain_id, window.blocks)
+                finally:
+                    self.__release(window)
+                height = sync.height = max(height, sync.height)
+                if height <= window.end:
+                    # Broken link to local tip, the source is on a fork or sent bad blocks
+                    log.info(f'{window} of {sync.chain_id} from {window.source} saved to {height}')
+                    window.source.stats.error()
+                    rest = Window(height, window.end)
+                    rest.tried.add(window.source)
+                    sync.windows.insert(0, rest)
+                    break
+            # Windows covered by blocks saved some other way
+            while len(sync.windows) > 0 and sync.windows[0].end < sync.height \
+                    and len(sync.windows[0].fetching) == 0:
+                self.__release(sync.windows.pop(0))
+            sync.next = max(sync.next, sync.height)
+
+    @staticmethod
+    def __save(chain_id: str, blocks: list) -> int:
+        """
+        :return: height of the chain after saving
+        """
+        chain = Blockchain.remote_chain(chain_id)
+        saved = chain.save_blocks(blocks, verified=True)
+        if saved < len(blocks):
+            log.info(f'{saved} of {len(blocks)} blocks saved for {chain_id}')
+        return chain.height
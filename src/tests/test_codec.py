@@ -0,0 +1,23 @@
+import time
+import pytest
+
+from networking import codec
+
+
+def test_roundtrip():
+    content = {'type': 'blocks', 'height': -3, 'blocks': [{'payload': 'x', 'end': True}], 'extra': 1.5}
+    assert codec.load(codec.dump(2, 'id', content)) == (2, 'id', content)
+
+
+def test_oversized_varint():
+    frame = codec.dump_header(0, 'id') + bytes([codec.INT]) + b'\xff' * 80000 + b'\x01'
+    start = time.perf_counter()
+    with pytest.raises(codec.DecodeError):
+        codec.load(frame)
+    assert time.perf_counter() - start < 0.01
+
+
+def test_count_larger_than_frame():
+    frame = codec.dump_header(0, 'id') + bytes([codec.LIST]) + b'\xff\xff\xff\xff\x0f'
+    with pytest.raises(codec.DecodeError):
+        codec.load(frame)
@@ -0,0 +1,47 @@
+import os
+
+from hashlib import sha256
+from base58 import b58encode
+from blockchain.embedded import ChainFiles
+
+
+def block(height: int) -> dict:
+    return {'hash': b58encode(sha256(str(height).encode()).digest()).decode('utf8'), 'height': height, 'payload': 'x'}
+
+
+def test_recover_partial_hash_entry(tmp_path):
+    path = str(tmp_path)
+    files = ChainFiles(path)
+    assert files.append([block(i) for i in range(3)]) == 3
+    files.close()
+
+    hash_index = os.path.join(path, 'hash.idx')
+    with open(hash_index, 'ab') as file:
+        file.write(ChainFiles.HASH_ENTRY.pack(b'\x01' * 32, 3)[:17])
+
+    files = ChainFiles(path)
+    assert os.path.getsize(hash_index) == 3 * ChainFiles.HASH_ENTRY.size
+    assert files.append([block(3)]) == 1
+    files.close()
+
+    files = ChainFiles(path)
+    assert os.path.getsize(hash_index) == 4 * ChainFiles.HASH_ENTRY.size
+    assert [files.find(block(i)['hash']) for i in range(4)] == [0, 1, 2, 3]
+    assert files.get(3) == block(3)
+
+
+def test_recover_partial_record(tmp_path):
+    path = str(tmp_path)
+    files = ChainFiles(path)
+    files.append([block(i) for i in range(2)])
+    end = files.end
+    files.close()
+
+    with open(os.path.join(path, 'blocks.dat'), 'ab') as file:
+        file.write(ChainFiles.RECORD_HEADER.pack(100) + b'{"hash"')
+
+    files = ChainFiles(path)
+    assert files.height == 2
+    assert os.path.getsize(os.path.join(path, 'blocks.dat')) == end
+    assert files.append([block(2)]) == 1
+    assert files.get(2) == block(2)
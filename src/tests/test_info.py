@@ -0,0 +1,44 @@
+import pytest
+
+from threading import Lock
+from utils import Singleton
+from sharing.digest import ChainDigest
+from sharing.sentence import Info, InfoSnapshot
+
+
+def snapshot_of(count: int) -> InfoSnapshot:
+    # Built without storage, only what Info reads from it
+    snapshot = InfoSnapshot.__new__(InfoSnapshot)
+    snapshot.platform = {'system': 'test', 'version': '0', 'node': 'test'}
+    snapshot.chains = {f'chain{i}': i + 1 for i in range(count)}
+    snapshot.digest = ChainDigest(snapshot.chains)
+    snapshot._InfoSnapshot__lock = Lock()
+    snapshot._InfoSnapshot__encoded = {}
+    return snapshot
+
+
+@pytest.fixture
+def snapshot(monkeypatch):
+    monkeypatch.setattr(InfoSnapshot, 'peers', property(lambda self: 0))
+
+    def install(count: int):
+        Singleton.instances[InfoSnapshot] = snapshot_of(count)
+    yield install
+    Singleton.instances.pop(InfoSnapshot, None)
+
+
+def question_size(version: str = Info.VERSION) -> int:
+    return len(Info(version=version).question.dump())
+
+
+def test_first_info_question_does_not_grow_with_chains(snapshot):
+    snapshot(10)
+    few = question_size()
+    snapshot(10000)
+    assert question_size() == few
+
+
+def test_legacy_info_question_carries_heights(snapshot):
+    snapshot(100)
+    assert len(Info(version=Info.LEGACY_VERSION).chains) == 100
+    assert Info().chains == {}
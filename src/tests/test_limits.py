@@ -0,0 +1,43 @@
+import sharing.share as share
+
+from types import SimpleNamespace
+from collections import OrderedDict
+from sharing.share import ShareManager
+
+
+def manager():
+    # Only what limits_of uses, without the event loop and peers of a real manager
+    return SimpleNamespace(limits=OrderedDict(), LIMITS_PER_INBOUND=ShareManager.LIMITS_PER_INBOUND)
+
+
+def limits_of(owner, address: str):
+    return ShareManager.limits_of(owner, SimpleNamespace(address=address))
+
+
+def test_limits_capped(monkeypatch):
+    monkeypatch.setattr(share, 'settings', share.settings._replace(
+        limits=share.settings.limits._replace(inbound=2)))
+    owner = manager()
+    cap = 2 * ShareManager.LIMITS_PER_INBOUND
+    first = limits_of(owner, 'first')
+    first.questions.take(5)
+    for i in range(cap - 1):
+        limits_of(owner, f'{i}').questions.take(5)
+    # Used again, so it is not the oldest any more
+    assert limits_of(owner, 'first') is first
+    for i in range(cap * 10):
+        limits_of(owner, f'flood{i}').questions.take(5)
+        assert len(owner.limits) <= cap
+    assert 'first' not in owner.limits
+
+
+def test_idle_limits_pruned(monkeypatch):
+    monkeypatch.setattr(share, 'settings', share.settings._replace(
+        limits=share.settings.limits._replace(inbound=2)))
+    owner = manager()
+    busy = limits_of(owner, 'busy')
+    busy.questions.take(5)
+    for i in range(10):
+        limits_of(owner, f'idle{i}')
+    assert owner.limits['busy'] is busy
+    assert len(owner.limits) <= 2
@@ -0,0 +1,22 @@
+from json import JSONDecoder
+from networking import Message, codec
+from sharing.sentence import Blocks
+
+
+def raw_blocks(count: int) -> list:
+    return [memoryview(b'{"chain_id":"2","hash":"3","height":%d,"payload":"p","signature":"4","time":1}' % i)
+            for i in range(count)]
+
+
+def test_blocks_frames_match():
+    answer = Blocks(raw=raw_blocks(3), end=False)
+    message = Message(answer.content, Message.Type.ANSWER, content_type=answer.type.value)
+    content = JSONDecoder().decode(message.dump())['content']
+    assert content['blocks'][2]['height'] == 2
+    assert codec.load(message.dump(binary=True)) == (list(Message.Type).index(Message.Type.ANSWER),
+                                                      message.identifier, content)
+
+
+def test_encoded_value_spliced():
+    assert codec.dump_value({'blocks': [codec.Encoded(codec.dump_value({'height': 1}))]}) == \
+        codec.dump_value({'blocks': [{'height': 1}]})
@@ -0,0 +1,30 @@
+import sys
+import subprocess
+
+from base58 import b58encode
+from validation import Key, BaseBlock, initialize_worker, verify_block
+
+
+def signed_block(key: Key, height: int = 0) -> BaseBlock:
+    block = BaseBlock()
+    block.chain_id = key.public_key
+    block.height = height
+    block.payload = 'payload'
+    block.block_hash = block.hash_data(block.data_for_hashing)
+    block.signature = b58encode(key.sign(block.data_for_hashing)).decode('utf8')
+    return block
+
+
+def test_worker_imports_no_settings():
+    code = "import sys, validation.block; print(sorted(m for m in sys.modules if m.split('.')[0] == 'utils'))"
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, check=True, text=True).stdout
+    assert output.strip() == '[]'
+
+
+def test_verify_block():
+    initialize_worker(4, 2)
+    key = Key()
+    block = signed_block(key)
+    assert verify_block(block.data)
+    block.payload = 'changed'
+    assert not verify_block(block.data)
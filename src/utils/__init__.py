@@ -1,3 +1,4 @@
 from .singleton import *
 from .settings import settings
 from .logger import default_logger as log
+from .executor import StorageExecutor
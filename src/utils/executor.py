@@ -0,0 +1,25 @@
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from .singleton import Singleton
+from .settings import settings
+
+
+class StorageExecutor(metaclass=Singleton):
+    """
+    Bounded thread pool for blocking storage calls made from event loops.
+
+    A slow disk or a busy database only delays the awaiting handler,
+    messages of other peers keep being processed.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=settings.database.workers, thread_name_prefix='storage')
+
+    async def run(self, func, *args, **kwargs):
+        """
+        :param func: blocking function
+        :return: result of func(*args, **kwargs)
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
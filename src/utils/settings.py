@@ -1,5 +1,6 @@
 import json
 import os
+import tempfile
 
 from collections import namedtuple
 from .getip import get_host_ip
@@ -12,6 +13,11 @@ class Settings:
             'host': 'localhost',
             'port': 27017,
             'name': 'infnote_chain',
+            'engine': 'mongo',
+            'path': '~/.infnote/data',
+            'workers': 8,
+            # Chains of embedded storage with data file kept open
+            'files': 256
         },
         'debug': True,
         'server': {
@@ -24,7 +30,63 @@ class Settings:
         },
         'peers': {
             'sync': False,
-            'retry': 5
+            'retry': 5,
+            # Seconds to wait for each answer of a question
+            'timeout': 30,
+            # Questions waiting for answers from one peer
+            'requests': 64,
+            # Seconds between keepalive pings
+            'ping': 30,
+            # Pings not answered in a row before disconnecting
+            'pings': 3,
+            # Messages queued for each peer, and messages dropped in a row before disconnecting it
+            'outbox': 256,
+            'drops': 32
+        },
+        'validation': {
+            'workers': 0
+        },
+        'keys': {
+            'capacity': 4096,
+            'precompute': 16
+        },
+        'broadcast': {
+            # Seconds and count of broadcasts remembered to drop duplicates
+            'ttl': 600,
+            'capacity': 65536
+        },
+        'limits': {
+            # Peers connected to this node at the same time
+            'inbound': 64,
+            # Questions answered per second for each peer, and the burst allowed
+            'questions': 10,
+            'questions_burst': 50,
+            # Bytes of blocks served per second for each peer, and the burst allowed
+            'bytes': 2**22,
+            'bytes_burst': 2**24,
+            # Ranges of blocks served to each peer at the same time
+            'serving': 2
+        },
+        'compression': {
+            # Sentence types compressed for peers supporting it, small control sentences are not worth it
+            'types': ['blocks', 'digest', 'peers'],
+            'level': 6,
+            'min_size': 1024,
+            # Limit of a message after decompression
+            'max_size': 2**23
+        },
+        'sync': {
+            # Blocks asked in one question, and questions in flight or buffered for a chain
+            'window': 512,
+            'windows': 16,
+            # Windows asked from one peer at the same time
+            'per_peer': 2,
+            # Seconds before the window holding back saving is asked from another peer
+            'stall': 10,
+            # Bytes of one window received before the rest is asked as another window
+            'window_bytes': 2**25,
+            # Bytes of blocks received and not saved yet, of every chain
+            'buffer': 2**28
         }
     }
 
@@ -39,9 +101,16 @@ class Settings:
         try:
             if not os.path.exists(os.path.dirname(path)):
                 os.makedirs(os.path.dirname(path))
-            with open(path, 'w+') as file:
-                content = json.JSONEncoder(indent=4).encode(value)
-                file.write(content)
+            # Every process rewrites it when loading, readers never see it half written
+            fd, temp = tempfile.mkstemp(prefix='settings.', suffix='.tmp', dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    file.write(json.JSONEncoder(indent=4).encode(value))
+                os.chmod(temp, 0o644)
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
             self.location = path
             return True
         except OSError as err:
@@ -62,6 +131,16 @@ class Settings:
                 self.__settings['database']['host'] = db_settings.get('host')
                 self.__settings['database']['port'] = db_settings.get('port')
                 self.__settings['database']['name'] = db_settings.get('name')
+                engine = db_settings.get('engine')
+                if engine in ('mongo', 'embedded'):
+                    self.__settings['database']['engine'] = engine
+                data_path = db_settings.get('path')
+                if data_path is not None and isinstance(data_path, str):
+                    self.__settings['database']['path'] = data_path
+                for key in ('workers', 'files'):
+                    value = db_settings.get(key)
+                    if value is not None and isinstance(value, int) and value > 0:
+                        self.__settings['database'][key] = value
 
             debug = user.get('debug')
             if debug is not None and isinstance(debug, bool):
@@ -93,6 +172,67 @@ class Settings:
                 retry = peers.get('retry')
                 if retry is not None and isinstance(retry, int):
                     self.__settings['peers']['retry'] = retry
+                timeout = peers.get('timeout')
+                if timeout is not None and isinstance(timeout, (int, float)) and timeout > 0:
+                    self.__settings['peers']['timeout'] = timeout
+                requests = peers.get('requests')
+                if requests is not None and isinstance(requests, int) and requests > 0:
+                    self.__settings['peers']['requests'] = requests
+                ping = peers.get('ping')
+                if ping is not None and isinstance(ping, (int, float)) and ping > 0:
+                    self.__settings['peers']['ping'] = ping
+                for key in ('pings', 'outbox', 'drops'):
+                    value = peers.get(key)
+                    if value is not None and isinstance(value, int) and value > 0:
+                        self.__settings['peers'][key] = value
+
+            validation = user.get('validation')
+            if validation is not None and isinstance(validation, dict):
+                workers = validation.get('workers')
+                if workers is not None and isinstance(workers, int):
+                    self.__settings['validation']['workers'] = workers
+
+            keys = user.get('keys')
+            if keys is not None and isinstance(keys, dict):
+                for key in ('capacity', 'precompute'):
+                    value = keys.get(key)
+                    if value is not None and isinstance(value, int) and value > 0:
+                        self.__settings['keys'][key] = value
+
+            broadcast = user.get('broadcast')
+            if broadcast is not None and isinstance(broadcast, dict):
+                for key in ('ttl', 'capacity'):
+                    value = broadcast.get(key)
+                    if value is not None and isinstance(value, int) and value > 0:
+                        self.__settings['broadcast'][key] = value
+
+            limits = user.get('limits')
+            if limits is not None and isinstance(limits, dict):
+                for key in ('inbound', 'questions', 'questions_burst', 'bytes', 'bytes_burst', 'serving'):
+                    value = limits.get(key)
+                    if value is not None and isinstance(value, (int, float)) and value > 0:
+                        self.__settings['limits'][key] = value
+
+            compression = user.get('compression')
+            if compression is not None and isinstance(compression, dict):
+                types = compression.get('types')
+                if types is not None and isinstance(types, list):
+                    self.__settings['compression']['types'] = types
+                level = compression.get('level')
+                # -1 is the default level of zlib
+                if level is not None and isinstance(level, int) and -1 <= level <= 9:
+                    self.__settings['compression']['level'] = level
+                for key in ('min_size', 'max_size'):
+                    value = compression.get(key)
+                    if value is not None and isinstance(value, int) and value > 0:
+                        self.__settings['compression'][key] = value
+
+            sync = user.get('sync')
+            if sync is not None and isinstance(sync, dict):
+                for key in ('window', 'windows', 'per_peer', 'stall', 'window_bytes', 'buffer'):
+                    value = sync.get(key)
+                    if value is not None and isinstance(value, int) and value > 0:
+                        self.__settings['sync'][key] = value
 
             self.location = path
 
@@ -1,7 +1,14 @@
+from threading import RLock
+
+
 class Singleton(type):
     instances = {}
+    # Instances may be created from worker threads, a singleton can create others in __init__
+    __lock = RLock()
 
     def __call__(cls, *args, **kwargs):
         if cls not in cls.instances:
-            cls.instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+            with Singleton.__lock:
+                if cls not in cls.instances:
+                    cls.instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls.instances[cls]
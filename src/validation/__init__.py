@@ -0,0 +1,2 @@
+from .key import *
+from .block import *
@@ -0,0 +1,194 @@
+import json
+
+from calendar import timegm
+from datetime import datetime
+from time import time
+from hashlib import sha256
+from base58 import b58encode
+from .key import Key, KeyCache
+
+
+CANONICAL_ENCODER = json.JSONEncoder(
+    separators=(',', ':'),
+    sort_keys=True,
+    ensure_ascii=False
+)
+
+
+class _Field:
+    """
+    Field of Block stored in a slot, a lazily loaded block is decoded on first access
+    and memoized encodings are dropped when the field changes.
+    """
+
+    def __init__(self, hashing: bool = True):
+        self.hashing = hashing
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.slot = '_' + name
+
+    def __get__(self, block, owner):
+        if block is None:
+            return self
+        if block._raw is not None:
+            block.decode()
+        return getattr(block, self.slot)
+
+    def __set__(self, block, value):
+        if block._raw is not None:
+            block.decode()
+        setattr(block, self.slot, value)
+        block._data = None
+        if self.hashing:
+            block._data_for_hashing = None
+
+
+class BaseBlock:
+    """
+    Block without storage and settings, validation workers load blocks as it
+    and `blockchain.Block` adds what needs the running node.
+    """
+
+    __slots__ = ('_block_hash', '_prev_hash', '_timestamp', '_signature', '_chain_id', '_height', '_payload',
+                 '_raw', '_data', '_data_for_hashing')
+
+    block_hash = _Field(hashing=False)
+    prev_hash = _Field()
+    # Seconds since epoch in UTC, `time` gives it as datetime
+    timestamp = _Field()
+    signature = _Field(hashing=False)
+    chain_id = _Field()
+    height = _Field()
+    payload = _Field()
+
+    def __init__(self, data: dict = None):
+        # Undecoded canonical bytes of a lazily loaded block
+        self._raw = None
+        # Memoized canonical encodings
+        self._data = None
+        self._data_for_hashing = None
+
+        if data is not None:
+            self.__load(data)
+        else:
+            self.__load({'hash': '', 'prev_hash': '', 'time': int(time()), 'signature': '',
+                         'chain_id': '', 'height': 0, 'payload': ''})
+
+    def __load(self, data: dict):
+        self._block_hash = data.get('hash')
+        self._prev_hash = data.get('prev_hash')
+        self._timestamp = data.get('time')
+        self._signature = data.get('signature')
+        self._chain_id = data.get('chain_id')
+        self._height = data.get('height')
+        self._payload = data.get('payload')
+
+    @classmethod
+    def from_raw(cls, raw: bytes, lazy: bool = True):
+        """
+        Load a block from its canonical encoded bytes and keep them for `data`
+
+        :param raw: bytes-like object
+        :param lazy: decode the block on first access of its fields
+        :return: Block
+        """
+        block = cls.__new__(cls)
+        block._raw = bytes(raw)
+        block._data = block._raw
+        block._data_for_hashing = None
+        if not lazy:
+            block.decode()
+        return block
+
+    def decode(self):
+        raw = self._raw
+        if raw is not None:
+            self._raw = None
+            self.__load(json.loads(raw))
+
+    @property
+    def time(self) -> datetime:
+        return datetime.utcfromtimestamp(self.timestamp)
+
+    @time.setter
+    def time(self, value: datetime):
+        self.timestamp = timegm(value.utctimetuple())
+
+    @staticmethod
+    def hash_data(data_for_hashing: bytes) -> str:
+        return b58encode(sha256(data_for_hashing).digest()).decode('utf8')
+
+    @property
+    def is_genesis(self):
+        return self.height == 0
+
+    @property
+    def utctime(self) -> int:
+        return self.timestamp
+
+    @property
+    def dict(self) -> dict:
+        data = {
+            'hash': self.block_hash,
+            'time': self.timestamp,
+            'signature': self.signature,
+            'chain_id': self.chain_id,
+            'height': self.height,
+            'payload': self.payload
+        }
+        if self.prev_hash is not None and len(self.prev_hash) > 0:
+            data['prev_hash'] = self.prev_hash
+        return data
+
+    @property
+    def data_for_hashing(self) -> bytes:
+        if self._data_for_hashing is None:
+            data = self.dict
+            del data['hash']
+            del data['signature']
+            self._data_for_hashing = CANONICAL_ENCODER.encode(data).encode('utf8')
+        return self._data_for_hashing
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = CANONICAL_ENCODER.encode(self.dict).encode('utf8')
+        return self._data
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def verify_with(self, key: Key) -> bool:
+        """
+        :param key: key of the chain the block claims to belong to
+        :return: True if the hash and the signature of the block are valid
+        """
+        data = self.data_for_hashing
+        return (self.height == 0 or (self.prev_hash is not None and len(self.prev_hash) > 0)) and \
+            self.hash_data(data) == self.block_hash and \
+            key.verify(self.signature, data)
+
+    def __eq__(self, other):
+        return isinstance(other, BaseBlock) and self.dict == other.dict
+
+
+# Keys of chains verified by a worker process of the validation pool
+_keys = None
+
+
+def initialize_worker(capacity: int, precompute_after: int):
+    """
+    Runs once in each worker process of the validation pool, workers can
+    not read settings since loading them may look up the host and rewrite
+    the settings file.
+    """
+    global _keys
+    _keys = KeyCache(capacity, precompute_after)
+
+
+def verify_block(data: bytes) -> bool:
+    # Runs in worker processes of the validation pool
+    block = BaseBlock.from_raw(data)
+    return block.verify_with(_keys.get(block.chain_id))